@@ -0,0 +1,62 @@
+import io
+import types
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+"""
+Local fake of the zenpy client, serving tickets with one zip attachment of synthetic X-rays.
+"""
+
+
+def make_zip(num_images=3, size=(1024, 512)):
+    """
+    Build a zip archive with synthetic JPEG X-rays and a non-image file.
+    """
+    rng = np.random.default_rng(0)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        for i in range(num_images):
+            pixels = rng.integers(0, 256, size=(size[1], size[0]), dtype=np.uint8)
+            image_buffer = io.BytesIO()
+            Image.fromarray(pixels).save(image_buffer, format="JPEG", quality=90)
+            zip_ref.writestr(f"xray_{i}.jpg", image_buffer.getvalue())
+        zip_ref.writestr("journal.txt", b"not an image")
+    return buffer.getvalue()
+
+
+class FakeZenpyClient:
+    """
+    Mimics the parts of zenpy.Zenpy used by the Zendesk class (views, tickets, attachments),
+    with an artificial network latency per request.
+    """
+    def __init__(self, num_tickets=50, latency=0.01, zip_bytes=None):
+        self.num_tickets = num_tickets
+        self.latency = latency
+        self.zip_bytes = zip_bytes if zip_bytes is not None else make_zip()
+        self.views = types.SimpleNamespace(tickets=self._view_tickets)
+        self.tickets = types.SimpleNamespace(comments=self._comments)
+        self.attachments = types.SimpleNamespace(download=self._download)
+
+    def _sleep(self):
+        if self.latency:
+            import time
+            time.sleep(self.latency)
+
+    def _view_tickets(self, view_id, **kwargs):
+        # A list supports both iteration and the slicing used to resume the listing
+        return [types.SimpleNamespace(id=ticket_id) for ticket_id in range(1, self.num_tickets + 1)]
+
+    def _comments(self, ticket_id):
+        self._sleep()
+        attachment = types.SimpleNamespace(id=ticket_id, file_name=f"ticket_{ticket_id}.zip")
+        return [types.SimpleNamespace(attachments=[attachment])]
+
+    def _download(self, attachment_id, destination=None):
+        self._sleep()
+        if destination is None:
+            return io.BytesIO(self.zip_bytes)
+        with open(destination, "wb") as f:
+            f.write(self.zip_bytes)
+        return destination
@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+"""
+Benchmarks of the hot paths of the annotation app, the preprocessing and the inference.
+Everything runs offline on synthetic X-ray-sized images (OCR and Zendesk are faked), and the
+results are written as JSON so that a run can be compared against a baseline:
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --baseline results.json
+"""
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The app and the zendesk modules use flat imports
+sys.path[:0] = [os.path.join(ROOT, "src", "app"), os.path.join(ROOT, "src", "zendesk"), os.path.dirname(__file__)]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat=5, warmup=1):
+    """
+    Time a function and summarize the durations in milliseconds.
+    """
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return {
+        "min_ms": round(durations[0], 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "p95_ms": round(durations[min(int(round(0.95 * (len(durations) - 1))), len(durations) - 1)], 3),
+        "repeat": repeat,
+    }
+
+
+def synthetic_xray(size=(4000, 2000), seed=0):
+    """
+    Build a synthetic panoramic-sized radiograph (RGB numpy array): a bright jaw-like
+    band on a dark background with black rows at the top and bottom.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    w, h = size
+    image = rng.normal(20, 5, size=(h, w)).clip(0, 255)
+    yy, xx = np.mgrid[0:h, 0:w]
+    band = np.exp(-((yy - h / 2) / (h / 4)) ** 2) * (0.6 + 0.4 * np.sin(xx / 37.0) ** 2)
+    image += 180 * band
+    image[: h // 10] = 0
+    image[-h // 10:] = 0
+    image = image.clip(0, 255).astype(np.uint8)
+    return np.repeat(image[:, :, None], 3, axis=2)
+
+
+def write_images(folder, count, size):
+    from PIL import Image
+
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        Image.fromarray(synthetic_xray(size, seed=i)).save(os.path.join(folder, f"xray_{i:05d}.jpg"), quality=90)
+    return folder
+
+
+@benchmark("read_images")
+def bench_read_images(tmp, quick):
+    from image_cache import SharedImageCache
+    from image_source import LazyImageSource
+
+    count = 10 if quick else 50
+    folder = write_images(os.path.join(tmp, "read_images"), count, (3000, 1500))
+    results = {"images": count}
+    results["index"] = measure(lambda: LazyImageSource(folder, prefetch=0, cache=SharedImageCache()))
+
+    # Cold decode of one image (fresh cache every time) and warm access (cache hit)
+    def cold_decode():
+        LazyImageSource(folder, prefetch=0, cache=SharedImageCache())[0]
+    results["decode_cold"] = measure(cold_decode)
+    source = LazyImageSource(folder, prefetch=0, cache=SharedImageCache())
+    results["decode_warm"] = measure(lambda: source[0], repeat=50)
+    return results
+
+
+@benchmark("canvas_resize_crop")
+def bench_canvas_resize_crop(tmp, quick):
+    import thumbnails
+    from PIL import Image
+    from image_cache import SharedImageCache
+    from image_source import LazyImageSource
+    from derivatives import DerivativeStore
+
+    folder = write_images(os.path.join(tmp, "canvas"), 3, (3000, 1500))
+    thumbnails.THUMBNAIL_PATH = os.path.join(tmp, "thumbnails")
+    results = {}
+
+    # The per-rerun LANCZOS resize of the full-resolution image (the path before the derivative store)
+    image = LazyImageSource(folder, prefetch=0, cache=SharedImageCache())[0]
+    results["resize_full"] = measure(lambda: image.resize((500, 500), Image.LANCZOS))
+
+    # Cold derivative build, derivative load from disk and cached canvas render
+    store = DerivativeStore(os.path.join(tmp, "derivatives"), 500)
+    results["derivative_build"] = measure(lambda: store.build(os.path.join(folder, "xray_00000.jpg"), image))
+    results["derivative_load"] = measure(lambda: store.load(os.path.join(folder, "xray_00000.jpg")))
+    source = LazyImageSource(folder, prefetch=0, cache=SharedImageCache(), derivatives=store)
+    results["canvas_cached"] = measure(lambda: source.canvas_image(0, 500), repeat=50)
+
+    # Crop of a tooth-sized box and its thumbnail encoding (a new crop every time, so nothing is reused)
+    canvas = source.canvas_image(0, 500)
+    offsets = iter(range(10 ** 6))
+    def crop_thumbnail():
+        offset = next(offsets) % 400
+        thumbnails.save_thumbnail(canvas.crop((offset, 100, offset + 60, 220)))
+    results["crop_thumbnail"] = measure(crop_thumbnail, repeat=20)
+    return results
+
+
+@benchmark("save_annotations")
+def bench_save_annotations(tmp, quick):
+    from annotations import ToothNumberAnnotations, get_journal
+
+    sizes = (100, 1000) if quick else (100, 1000, 10000)
+    boxes_per_image = 32
+    results = {}
+    for size in sizes:
+        save_path = os.path.join(tmp, f"annotations_{size}")
+        coco = ToothNumberAnnotations()
+        journal = get_journal(os.path.join(save_path, coco.type))
+
+        # Fill the journal with the images annotated so far
+        images = [{"id": i, "file_name": f"xray_{i}.jpg", "width": 500, "height": 500} for i in range(size)]
+        annotations = [{"image_id": i, "category_id": j + 1, "bbox": [j, j, 20, 40], "area": 800, "iscrowd": 0}
+                       for i in range(size) for j in range(boxes_per_image)]
+        journal.append(images, annotations)
+
+        submitted = iter(range(size, size + 10 ** 6))
+        def submit():
+            image_id = next(submitted)
+            coco.add_image(image_id, f"xray_{image_id}.jpg", image_size=(500, 500))
+            for j in range(boxes_per_image):
+                coco.add_annotation(j, image_id, j + 1, [j, j, 20, 40])
+            assert coco.save_annotations(save_path)
+        results[f"submit_at_{size}"] = measure(submit, repeat=20)
+        results[f"export_at_{size}"] = measure(lambda: coco.export_annotations(save_path), repeat=3)
+    return results
+
+
+@benchmark("preprocess_image")
+def bench_preprocess_image(tmp, quick):
+    import image_preprocessing
+
+    # Fake OCR: a few boxes of burned-in text in the corners
+    def fake_image_to_data(image, config="", output_type=None):
+        h, w = image.shape[:2]
+        return {
+            "level": [5, 5, 5],
+            "left": [10, w - 300, 20],
+            "top": [10, 15, h - 60],
+            "width": [200, 280, 150],
+            "height": [40, 40, 40],
+            "conf": [95, 90, 30],
+            "text": ["NAME", "2024-01-01", "R"],
+        }
+    image_preprocessing.pytesseract.image_to_data = fake_image_to_data
+
+    image = synthetic_xray((4000, 2000))
+    repeat = 3 if quick else 10
+    stages = {}
+    def run():
+        timings = {}
+        image_preprocessing.preprocess_image(image, timings=timings)
+        for stage, duration in timings.items():
+            stages.setdefault(stage, []).append(duration * 1000)
+    results = {"total": measure(run, repeat=repeat)}
+    for stage, durations in stages.items():
+        results[f"stage_{stage}"] = {"median_ms": round(statistics.median(durations), 3)}
+    results["remove_text"] = measure(lambda: image_preprocessing.remove_text(image, fake_image_to_data(image)), repeat=repeat)
+    results["thresholding_crop_median"] = measure(
+        lambda: image_preprocessing.thresholding_crop(image, type="median", threshold=40), repeat=repeat)
+    results["thresholding_crop_mean"] = measure(
+        lambda: image_preprocessing.thresholding_crop(image, type="average", threshold=40), repeat=repeat)
+    return results
+
+
+@benchmark("inference")
+def bench_inference(tmp, quick):
+    import torch
+    from PIL import Image
+    from classification_model_inference import Classification, prepare_images, predict
+
+    torch.manual_seed(0)
+    # Random weights: the throughput does not depend on the weight values
+    model = Classification(num_classes=5, pretrained=False).eval()
+    image = Image.fromarray(synthetic_xray((2000, 1000)))
+    results = {}
+    for batch_size in ((1, 8) if quick else (1, 8, 32)):
+        images = [image] * batch_size
+        prepare = measure(lambda: prepare_images(images), repeat=3)
+        batch = prepare_images(images)
+        forward = measure(lambda: predict(model, batch), repeat=3)
+        results[f"batch_{batch_size}"] = {
+            "prepare": prepare,
+            "predict": forward,
+            "images_per_second": round(batch_size / ((prepare["median_ms"] + forward["median_ms"]) / 1000), 2),
+        }
+    return results
+
+
+@benchmark("zendesk_ingestion")
+def bench_zendesk_ingestion(tmp, quick):
+    from fake_zendesk import FakeZenpyClient, make_zip
+    from zendesk_class import Zendesk
+
+    num_tickets = 20 if quick else 100
+    results = {"tickets": num_tickets}
+    zip_bytes = make_zip()
+    for max_workers in (1, 8):
+        for mode in ("extract", "store"):
+            def ingest():
+                root = tempfile.mkdtemp(dir=tmp)
+                # One client per worker thread, as with the real zenpy client
+                zendesk = Zendesk(client_factory=lambda: FakeZenpyClient(
+                    num_tickets=num_tickets, latency=0.01, zip_bytes=zip_bytes))
+                image_store = os.path.join(root, "store") if mode == "store" else None
+                zendesk.retrieve_all_image_data(os.path.join(root, "data"), max_workers=max_workers,
+                                                image_store=image_store)
+            results[f"{mode}_workers_{max_workers}"] = measure(ingest, repeat=1 if quick else 3, warmup=0)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the median durations relative to the baseline and return the regressions.
+    """
+    regressions = []
+
+    def walk(current, previous, path):
+        for key, value in current.items():
+            if key not in previous:
+                continue
+            if isinstance(value, dict):
+                walk(value, previous[key], f"{path}.{key}" if path else key)
+            elif key == "median_ms" and previous[key]:
+                ratio = value / previous[key]
+                flag = "REGRESSION" if ratio > 1 + tolerance else ""
+                print(f"{path:60s} {previous[key]:10.3f} -> {value:10.3f} ms ({ratio:5.2f}x) {flag}")
+                if flag:
+                    regressions.append(path)
+
+    walk(results["results"], baseline["results"], "")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmarks and write the results as JSON.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Path of the JSON results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown before flagging a regression")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Smaller datasets and fewer repetitions")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "quick": args.quick,
+        },
+        "results": {},
+    }
+
+    tmp = tempfile.mkdtemp(prefix="benchmarks_")
+    try:
+        for name in args.only or BENCHMARKS:
+            print(f"Running {name}...")
+            try:
+                results["results"][name] = BENCHMARKS[name](tmp, args.quick)
+            except ImportError as e:
+                # Benchmarks of optional parts (e.g. torch) are skipped when their dependencies are missing
+                results["results"][name] = {"skipped": str(e)}
+                print(f"Skipped {name}: {e}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,140 +1,325 @@
 from streamlit_drawable_canvas import st_canvas
 import os
 import streamlit as st
-from PIL import Image
 from streamlit_theme import st_theme
-import pandas as pd
-from io import BytesIO
-import base64
-import time
 import math
+import uuid
 
 from colormaps import *
+from image_source import LazyImageSource, index_image_paths
+from derivatives import get_derivative_store
+from box_buffer import BoxBuffer
+from thumbnails import save_thumbnail, thumbnail_url
+from perf import PERF_METRICS, process_rss_bytes, session_state_bytes
+from write_behind import WRITE_BEHIND_QUEUE
+from tile_pyramid import get_tile_store, make_viewport, source_image_size
 
 
 # Constants
 ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 DATA_PATH = os.path.join(ROOT, "temp_images")
 SAVE_PATH = os.path.join(ROOT, "output")
+# Precomputed canvas-size renders of the images in DATA_PATH
+DERIVATIVE_PATH = os.path.join(ROOT, "derivatives")
 if not os.path.exists(SAVE_PATH):
     os.makedirs(SAVE_PATH)
 
 # Defines the canvas size
 TARGET_IMAGE_SIZE = 500
+# Maximum zoom of the canvas view (the zoomed views are rendered from the tile pyramids in DERIVATIVE_PATH)
+MAX_ZOOM = 8
 
-def pil_image_to_data_url(img):
+# Rerun metrics in the Prometheus text format, served at app/static/metrics/metrics.txt by default
+METRICS_PATH = os.environ.get(
+    "METRICS_PATH", os.path.join(os.path.dirname(__file__), "static", "metrics", "metrics.txt"))
+# Show the performance panel in the sidebar (also enabled per session with the ?debug=1 query parameter)
+PERF_DEBUG = os.environ.get("PERF_DEBUG", "").lower() in ("1", "true")
+
+# Number of upcoming images of the annotator's queue prepared in the background
+PREFETCH_COUNT = int(os.environ.get("PREFETCH_COUNT", 3))
+# How long moving to the previous image waits for the pending background saves
+SAVE_WAIT_SECONDS = 5
+
+def timed(phase):
     """
-    Convert a PIL image to a data URL.
-    :param img: The PIL image to convert
-    :return: The data URL string
+    Time a phase of the current rerun of the annotation page.
     """
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
-
+    return PERF_METRICS.timer(st.session_state.get("page_title"), phase)
 
 def read_images(image_type=None):
     """
-    Read images from the specified directory.
+    Index the images in the specified directory. The images are decoded lazily when accessed.
     :param image_type: The type of images to read
-    :return: A list of PIL images
+    :return: A list-like LazyImageSource of PIL images
     """
-    images = []
     image_paths = os.path.join(DATA_PATH, image_type.value) if image_type else DATA_PATH
-    for image_file in os.listdir(image_paths):
-        images.append(
-            Image.open(os.path.join(image_paths, image_file)).convert("RGB")
-        )
-    return images
+    return LazyImageSource(
+        image_paths, derivatives=get_derivative_store(DERIVATIVE_PATH, TARGET_IMAGE_SIZE))
 
-def get_current_image():
+def list_image_file_names(image_type=None):
     """
-    Get the current image from the list of images based on the current index.
+    List the file names (relative to DATA_PATH) of the images to annotate, in the annotation order.
+    These names identify the images in the annotation journal.
     """
-    if st.session_state.current_image_index < len(st.session_state.images):
-        return st.session_state.images[st.session_state.current_image_index]
+    image_paths = os.path.join(DATA_PATH, image_type.value) if image_type else DATA_PATH
+    return [os.path.relpath(path, DATA_PATH) for path in index_image_paths(image_paths)]
+
+def get_file_name(index):
+    """
+    Get the file name (relative to DATA_PATH) of the image at the given index.
+    """
+    return os.path.relpath(st.session_state.images.path(index), DATA_PATH)
+
+def claim_image(index):
+    """
+    Claim the image at the given index for this session's annotator (or renew the claim).
+    The annotator may revisit (and re-submit) an already submitted image.
+    :return: False if the image is claimed by another annotator
+    """
+    journal = st.session_state.coco_data.get_journal(SAVE_PATH)
+    return journal.claim(get_file_name(index), st.session_state.annotator_id, allow_completed=True)
+
+def claim_next_image(start, exclude=()):
+    """
+    Claim the first image from the given index on (wrapping around to the first image)
+    which is neither annotated nor claimed by another annotator.
+    :param exclude: Indices not to claim
+    :return: The index of the claimed image or None if no image is left
+    """
+    images = st.session_state.images
+    journal = st.session_state.coco_data.get_journal(SAVE_PATH)
+    file_names = [get_file_name(i) for i in range(len(images))]
+    return journal.claim_next(file_names, st.session_state.annotator_id, start=start, exclude=exclude)
+
+def renew_claim():
+    """
+    Renew the claim on the current image while the annotator is working on it.
+    The image is read-only in this session if another annotator took it over (e.g. after the claim expired).
+    """
+    index = st.session_state.current_image_index
+    st.session_state.claim_lost = index < len(st.session_state.images) and not claim_image(index)
+
+def load_saved_boxes():
+    """
+    Load the saved boxes of the current image into the annotation buffer, so that revisiting
+    and re-submitting a submitted image keeps its annotations.
+    """
+    index = st.session_state.current_image_index
+    if index >= len(st.session_state.images):
+        return
+    journal = st.session_state.coco_data.get_journal(SAVE_PATH)
+    saved = journal.image_annotations(get_file_name(index))
+    if not saved:
+        return
+    # The thumbnails are cropped from the whole image view, as when the boxes were drawn at zoom 1
+    images = st.session_state.images
+    canvas_image = images.canvas_image(index, TARGET_IMAGE_SIZE)
+    viewport = make_viewport(source_image_size(images.path(index)), TARGET_IMAGE_SIZE)
+    for label, (x_min, y_min, width, height) in saved:
+        x, y, w, h = viewport.to_canvas(x_min, y_min, width, height)
+        thumbnail = save_thumbnail(canvas_image.crop((x, y, x + w, y + h)))
+        st.session_state.annotation_boxes.append(label, x_min, y_min, width, height, thumbnail)
+
+def get_current_viewport():
+    """
+    Get the region of the current image (in original pixels) shown on the canvas at the current zoom.
+    """
+    index = st.session_state.current_image_index
+    if index < len(st.session_state.images):
+        return make_viewport(
+            source_image_size(st.session_state.images.path(index)), TARGET_IMAGE_SIZE,
+            st.session_state.zoom, st.session_state.view_center)
     return None
 
+def get_current_canvas_image(viewport):
+    """
+    Get the view of the current image rendered at the canvas size (cached across reruns and sessions).
+    The whole image comes from the canvas-size derivative, the zoomed views from the tile pyramid.
+    """
+    index = st.session_state.current_image_index
+    if viewport is None or index >= len(st.session_state.images):
+        return None
+    images = st.session_state.images
+    if st.session_state.zoom <= 1:
+        return images.canvas_image(index, TARGET_IMAGE_SIZE)
+    return get_tile_store(DERIVATIVE_PATH).render(images.path(index), viewport, loader=lambda: images[index])
+
+def set_view(zoom, center):
+    """
+    Change the zoom and the center of the view (normalized to [0, 1]) and redraw the canvas.
+    """
+    zoom = min(max(zoom, 1), MAX_ZOOM)
+    # Pan at most to the edges of the image
+    margin = 0.5 / zoom
+    center = tuple(min(max(c, margin), 1 - margin) for c in center)
+    st.session_state.zoom = zoom
+    st.session_state.view_center = center
+    # A new canvas key redraws the canvas with the boxes of the new view
+    st.session_state.canvas_key = (
+        f"canvas_{st.session_state.current_image_index}_{zoom}_{center[0]:.4f}_{center[1]:.4f}")
+
+def create_zoom_controls():
+    """
+    Show the zoom and pan buttons of the canvas.
+    """
+    zoom = st.session_state.zoom
+    cx, cy = st.session_state.view_center
+    # Pan by half of the view
+    step = 0.5 / zoom
+    cols = st.columns(7)
+    if cols[0].button("Zoom in", disabled=zoom >= MAX_ZOOM, use_container_width=True):
+        set_view(zoom * 2, (cx, cy))
+    if cols[1].button("Zoom out", disabled=zoom <= 1, use_container_width=True):
+        set_view(zoom / 2, (cx, cy))
+    if cols[2].button("Reset", disabled=zoom <= 1, use_container_width=True):
+        set_view(1, (0.5, 0.5))
+    for col, label, (dx, dy) in zip(
+            cols[3:], ("←", "→", "↑", "↓"), ((-step, 0), (step, 0), (0, -step), (0, step))):
+        if col.button(label, disabled=zoom <= 1, use_container_width=True):
+            set_view(zoom, (cx + dx, cy + dy))
+
+def upcoming_image_indices(count=PREFETCH_COUNT):
+    """
+    Get the indices of the images the annotator is likely to move to next: the next images
+    which are free to annotate (as next_image would claim them) and the previous image.
+    """
+    index = st.session_state.current_image_index
+    journal = st.session_state.coco_data.get_journal(SAVE_PATH)
+    taken = journal.completed_file_names() | journal.claimed_file_names(
+        exclude_annotator=st.session_state.annotator_id)
+    upcoming = []
+    num_images = len(st.session_state.images)
+    for i in [*range(index + 1, num_images), *range(min(index, num_images))]:
+        if len(upcoming) >= count:
+            break
+        if get_file_name(i) not in taken:
+            upcoming.append(i)
+    if 0 < index <= len(st.session_state.images):
+        upcoming.append(index - 1)
+    return upcoming
+
+def prefetch_upcoming_images():
+    """
+    Prepare the canvas renders of the upcoming images in the background (once per image),
+    so that moving to the next/previous image does not wait for the decoding and resizing.
+    """
+    index = st.session_state.current_image_index
+    if st.session_state.get("prefetched_index") == index:
+        return
+    st.session_state.prefetched_index = index
+    st.session_state.images.prefetch_indices(upcoming_image_indices(), canvas_size=TARGET_IMAGE_SIZE)
+
 def reset_session_state():
     """
-    Reset the session state (clear the annotation dataframe and reset the tooth number).
+    Reset the session state (reset the tooth number and the annotation boxes to the saved ones of the image).
     """
     st.session_state.processed_object_count = 0
     st.session_state.tooth_number = 1       # Default tooth number
-    st.session_state.annotation_df = pd.DataFrame(columns=[
-        "label", 
-        "x_min", "y_min", 
-        "width", "height", 
-        "cropped_image"])
+    st.session_state.annotation_boxes = BoxBuffer()
+    load_saved_boxes()
+    st.session_state.zoom = 1
+    st.session_state.view_center = (0.5, 0.5)
     # Update the canvas key to clear the canvas
     st.session_state.canvas_key = f"canvas_{st.session_state.current_image_index}"
     st.rerun()
 
-def next_image():
+def next_image(release=True):
     """
-    Move to the next image in the list and reset the annotation dataframe.
+    Move to the next image which is free to annotate and reset the annotation boxes.
+    :param release: Release the claim on the current image (not when it was submitted, as saving it releases the claim)
     """
-    st.session_state.current_image_index += 1
-    if st.session_state.current_image_index >= len(st.session_state.images):
-        st.success("All images have been annotated.")
-        st.stop()
+    index = st.session_state.current_image_index
+    if release and index < len(st.session_state.images):
+        # Skipping an image makes it available to the other annotators again
+        st.session_state.coco_data.get_journal(SAVE_PATH).release(
+            get_file_name(index), st.session_state.annotator_id)
+    # The image just left is not offered again right away
+    next_index = claim_next_image(index + 1, exclude={index})
+    # Without a free image, the page shows the end of the queue (see create_main_page)
+    st.session_state.current_image_index = len(st.session_state.images) if next_index is None else next_index
     reset_session_state()
     
     
 def previous_image():
     """
-    Move to the previous image in the list and reset the annotation dataframe.
+    Move to the previous image in the list and reset the annotation boxes.
     """
-    st.session_state.current_image_index -= 1
+    index = st.session_state.current_image_index - 1
+    if not claim_image(index):
+        st.warning("The previous image is being annotated by another annotator.")
+        return
+    # The saved boxes of the previous image are loaded, so its save must have finished
+    if not WRITE_BEHIND_QUEUE.flush(timeout=SAVE_WAIT_SECONDS):
+        st.warning("The annotations of the previous image are still being saved. Please try again.")
+        return
+    if st.session_state.current_image_index < len(st.session_state.images):
+        st.session_state.coco_data.get_journal(SAVE_PATH).release(
+            get_file_name(st.session_state.current_image_index), st.session_state.annotator_id)
+    st.session_state.current_image_index = index
     reset_session_state()
     
     
 def delete_annotation(idx):
-    st.session_state.annotation_df.drop(idx, inplace=True)
-    st.session_state.annotation_df.reset_index(drop=True, inplace=True)
+    st.session_state.annotation_boxes.delete(idx)
     st.rerun()
     
 def annotation_exists(x_min, y_min, width, height):
-    if st.session_state.annotation_df[
-        (st.session_state.annotation_df["x_min"] == x_min) &
-        (st.session_state.annotation_df["y_min"] == y_min) &
-        (st.session_state.annotation_df["width"] == width) &
-        (st.session_state.annotation_df["height"] == height)
-        ].empty:
-        return False
-    return True
+    return st.session_state.annotation_boxes.contains(x_min, y_min, width, height)
     
     
 def submit_annotation():
-    # FIXME: Theese have to be unique
+    # The journal identifies the images by their file name and assigns the final ids
     image_id = st.session_state.current_image_index
+    file_name = get_file_name(image_id)
+    coco_data = st.session_state.coco_data
     
     # Add the current image to the coco data
-    # FIXME: Not sure about the TARGET_IMAGE_SIZE
-    # It depends on how the anotated images will be saved and whther they will be resized before or after
-    st.session_state.coco_data.add_image(
-        image_id, f"image_{image_id}.jpg", 
-        image_size=(TARGET_IMAGE_SIZE, TARGET_IMAGE_SIZE))   
-
-    for idx, row in st.session_state.annotation_df.iterrows():
-        st.session_state.coco_data.add_annotation(
-            idx, image_id, row["label"], 
-            [row["x_min"], row["y_min"], row["width"], row["height"]])
+    # The boxes are in the pixel coordinates of the original image, whatever the zoom they were drawn at
+    coco_data.add_image(
+        image_id, file_name, 
+        image_size=source_image_size(st.session_state.images.path(image_id)))   
+
+    for idx, (label, x_min, y_min, width, height, _) in enumerate(st.session_state.annotation_boxes):
+        coco_data.add_annotation(
+            idx, image_id, label, 
+            [x_min, y_min, width, height])
         
-    if st.session_state.coco_data.save_annotations(SAVE_PATH):
-        # Create a placeholder for the success message
-        success_placeholder = st.empty()
-        success_placeholder.success("Annotations saved successfully.")
-        # Wait for n seconds
-        time.sleep(1)
-        # Clear the success message
-        success_placeholder.empty()
-    else:
-        st.error("Failed to save annotations.")
+    # Save in the background, so the next image is shown without waiting for the write
+    # (failures are reported on the next rerun, see report_saves)
+    images, annotations = coco_data.pop_pending()
+    journal = coco_data.get_journal(SAVE_PATH)
+    annotator = st.session_state.annotator_id
+    # Writes which keep failing are also saved next to the journal, in case the session has ended
+    WRITE_BEHIND_QUEUE.submit(
+        annotator, file_name, lambda: journal.append(images, annotations, annotator=annotator),
+        dead_letter_path=os.path.join(os.path.dirname(journal.db_path), "failed_writes.jsonl"),
+        record={"images": images, "annotations": annotations, "annotator": annotator})
+    # Shown after the rerun, as st.rerun would clear it right away
+    st.session_state.save_toast = f"Annotations of {file_name} submitted."
 
     # Show the next image
-    next_image()
+    next_image(release=False)
+    
+    
+def report_saves():
+    """
+    Report the background saves of this session: a toast after a submit, and the failed saves with a retry button.
+    """
+    message = st.session_state.pop("save_toast", None)
+    if message:
+        st.toast(message)
+
+    annotator = st.session_state.annotator_id
+    failures = st.session_state.get("failed_saves", []) + WRITE_BEHIND_QUEUE.pop_failures(annotator)
+    st.session_state.failed_saves = failures
+    if failures:
+        file_names = ", ".join(failure.description for failure in failures)
+        st.error(f"Failed to save the annotations of {file_names}: {failures[-1].error}")
+        if st.button("Retry saving", type="primary"):
+            WRITE_BEHIND_QUEUE.retry(annotator, failures)
+            st.session_state.failed_saves = []
+            st.session_state.save_toast = "Saving the annotations again."
+            st.rerun()
     
     
 def toggle_help():
@@ -146,24 +331,26 @@ def init_session_state(coco_annotations):
     if "images" not in st.session_state:
         # Read the images from the dataset
         st.session_state.images = read_images()
-        # Initialize the current image index (index of the current image being displayed)
-        st.session_state.current_image_index = 0
-        # Initialize the annotation dataframe
-        st.session_state.annotation_df = pd.DataFrame(columns=[
-            "label", 
-            "x_min", "y_min", 
-            "width", "height", 
-            "cropped_image"])
+        st.session_state.coco_data = coco_annotations
+        # Identifies this session in the claims of the shared annotation journal
+        st.session_state.annotator_id = uuid.uuid4().hex
+        # Initialize the current image index (index of the first image free to annotate)
+        next_index = claim_next_image(0)
+        st.session_state.current_image_index = len(st.session_state.images) if next_index is None else next_index
+        # Initialize the buffer of the annotation boxes
+        st.session_state.annotation_boxes = BoxBuffer()
         # Set default label number
         st.session_state.label_id = 0  
         st.session_state.current_labels = None
         # Helps to keep track of the number of objects processed in the canvas
         st.session_state.processed_object_count = 0
-        st.session_state.coco_data = coco_annotations
         st.session_state.canvas_key = "canvas"
+        # Zoom and center (normalized) of the canvas view
+        st.session_state.zoom = 1
+        st.session_state.view_center = (0.5, 0.5)
         
         
-def build_html_table(dataframe):     
+def build_html_table(boxes):     
     
     # Start HTML string for table   
     html = f"""     
@@ -174,12 +361,8 @@ def build_html_table(dataframe):
             <th>Cropped Image</th>   
         </tr>"""
     
-    for _, row in dataframe.iterrows():         
-        label_id = row["label"]
+    for label_id, x_min, y_min, width, height, cropped in boxes:         
         label = st.session_state.current_labels[label_id]
-        x_min, y_min = row["x_min"], row["y_min"]    
-        width, height = row["width"], row["height"]         
-        cropped = row["cropped_image"]
         bbox = f"[{x_min}, {y_min}, {width}, {height}]"
 
         html += f"""         
@@ -187,7 +370,7 @@ def build_html_table(dataframe):
             <td>{label}</td>           
             <td>{bbox}</td>
             <td> 
-                <img src="{cropped}" alt="Cropped" style="height: 50px; width: auto;"/>
+                <img src="{thumbnail_url(cropped)}" alt="Cropped" style="height: 50px; width: auto;"/>
             </td>
         </tr> """
     
@@ -200,10 +383,10 @@ def create_sidebar(labels):
     
         # 1. Progress bar for the annotation process
         st.markdown("### Annotation Progress")
-        progress_value = (st.session_state.current_image_index + 1) / len(st.session_state.images)
+        progress_value = min((st.session_state.current_image_index + 1) / max(len(st.session_state.images), 1), 1.0)
         st.progress(progress_value)
         
-        num_remaining_images = len(st.session_state.images) - (st.session_state.current_image_index + 1)
+        num_remaining_images = max(len(st.session_state.images) - (st.session_state.current_image_index + 1), 0)
         st.markdown(f"""
             <div style="display: flex; justify-content: space-between;">
                 <span>Image <b>{st.session_state.current_image_index + 1}</b> of <b>{len(st.session_state.images)}</b></span>
@@ -243,8 +426,12 @@ def create_sidebar(labels):
          # 4. User Action Buttons
         st.markdown("### Actions")
         
-        if st.button("Submit", type="primary", use_container_width=True):
-            submit_annotation()
+        # The image is read-only if another annotator took it over
+        submit_disabled = (
+            st.session_state.current_image_index >= len(st.session_state.images) or st.session_state.claim_lost)
+        if st.button("Submit", type="primary", use_container_width=True, disabled=submit_disabled):
+            with timed("submit"):
+                submit_annotation()
             
         # Help button
         if st.button("Toggle Help", use_container_width=True, type="primary"):
@@ -258,121 +445,225 @@ def create_sidebar(labels):
             if st.button("Previous Image", use_container_width=True, disabled=prev_disabled, type="primary"):
                 previous_image()
         with col2:
-            # Disable the Next button if we're at the last image
-            next_disabled = st.session_state.current_image_index >= len(st.session_state.images) - 1
+            # Disable the Next button past the end of the queue (the search for the next image wraps around)
+            next_disabled = st.session_state.current_image_index >= len(st.session_state.images)
             if st.button("Next Image", use_container_width=True, disabled=next_disabled, type="primary"):
                 next_image()
         
 def create_main_page():
+    if st.session_state.current_image_index < len(st.session_state.images):
+        create_zoom_controls()
+
     # Display current image and progress
-    current_image = get_current_image()
-    if current_image is None:
-        st.error("No images found.")
+    with timed("image_fetch"):
+        viewport = get_current_viewport()
+        resized_image = get_current_canvas_image(viewport)
+    if resized_image is None:
+        if len(st.session_state.images) == 0:
+            st.error("No images found.")
+        elif st.session_state.coco_data.get_journal(SAVE_PATH).remaining_count(
+                [get_file_name(i) for i in range(len(st.session_state.images))]) == 0:
+            st.success("All images have been annotated.")
+        else:
+            st.info("No image is free to annotate right now, the remaining ones are being annotated. Please check back later.")
+        return
+
+    # Scheduled after the current image was loaded, so it does not compete with the prefetching
+    prefetch_upcoming_images()
+
+    if st.session_state.claim_lost:
+        # Shown without the canvas, so no boxes can be drawn on the image
+        st.warning("This image is currently being annotated by another annotator.")
+        st.image(resized_image, width=TARGET_IMAGE_SIZE)
         return
-        
-    resized_image = current_image.resize((TARGET_IMAGE_SIZE, TARGET_IMAGE_SIZE), Image.LANCZOS)
     
+    # Draw the boxes visible in the view (the boxes are stored in original pixel coordinates)
+    drawn_boxes = [
+        viewport.to_canvas(x_min, y_min, width, height)
+        for _, x_min, y_min, width, height, _ in st.session_state.annotation_boxes
+        if viewport.intersects(x_min, y_min, width, height)]
+    if st.session_state.get("drawn_canvas_key") != st.session_state.canvas_key:
+        # A new canvas starts with the drawn boxes, which are not new annotations
+        st.session_state.drawn_canvas_key = st.session_state.canvas_key
+        st.session_state.processed_object_count = len(drawn_boxes)
+
     # Display the canvas with the overlayed image
-    canvas_result = st_canvas(
-        fill_color="",
-        stroke_width=2,
-        background_color="#FFFFFF",
-        update_streamlit=True,
-        stroke_color="#cf0029",
-        background_image=resized_image,
-        width=TARGET_IMAGE_SIZE,
-        height=TARGET_IMAGE_SIZE,
-        drawing_mode="rect",
-        key=st.session_state.canvas_key,
-        initial_drawing={
-        "version": "4.4.0",
-        "objects": [
-            {
-                "type": "rect",
-                "left": row["x_min"], "top": row["y_min"],
-                "width": row["width"], "height": row["height"],
-                "fill": "rgba(0,0,0,0)", "stroke": "#cf0029", "strokeWidth": 2
-            }
-            for _, row in st.session_state.annotation_df.iterrows()]})
+    with timed("st_canvas"):
+        canvas_result = st_canvas(
+            fill_color="",
+            stroke_width=2,
+            background_color="#FFFFFF",
+            update_streamlit=True,
+            stroke_color="#cf0029",
+            background_image=resized_image,
+            width=TARGET_IMAGE_SIZE,
+            height=TARGET_IMAGE_SIZE,
+            drawing_mode="rect",
+            key=st.session_state.canvas_key,
+            initial_drawing={
+            "version": "4.4.0",
+            "objects": [
+                {
+                    "type": "rect",
+                    "left": x_min, "top": y_min,
+                    "width": width, "height": height,
+                    "fill": "rgba(0,0,0,0)", "stroke": "#cf0029", "strokeWidth": 2
+                }
+                for x_min, y_min, width, height in drawn_boxes]})
         
          # Handle canvas result
     if canvas_result and canvas_result.json_data is not None:
         objects = canvas_result.json_data["objects"]
         new_objects = objects[st.session_state.processed_object_count:]
         
-        for obj in new_objects:
-            
-            height, width = obj["height"], obj["width"]
-            x_min, y_min = obj["left"], obj["top"]
-            # Check if the annotation already exists
-            if annotation_exists(x_min, y_min, width, height):
-                continue
-            
-            cropped_image = resized_image.crop((x_min, y_min, x_min + width, y_min + height))
-            data_url = pil_image_to_data_url(cropped_image)
-            
-            row = {
-                "label": st.session_state.label_id,
-                "x_min": x_min, "y_min": y_min,
-                "width": width, "height": height,
-                "cropped_image": data_url,
-            }
-            # Add the row to the dataframe st.session_state.annotation_df
-            st.session_state.annotation_df.loc[len(st.session_state.annotation_df)] = row
+        with timed("crop_encoding"):
+            for obj in new_objects:
+                
+                height, width = obj["height"], obj["width"]
+                x_min, y_min = obj["left"], obj["top"]
+                # Map the box to the pixel coordinates of the original image
+                box = tuple(round(value, 2) for value in viewport.to_original(x_min, y_min, width, height))
+                # Check if the annotation already exists
+                if annotation_exists(*box):
+                    continue
+                
+                # The crop is taken from the view, which already has the canvas resolution
+                cropped_image = resized_image.crop((x_min, y_min, x_min + width, y_min + height))
+                thumbnail = save_thumbnail(cropped_image)
+                
+                # Add the box to the annotation buffer
+                st.session_state.annotation_boxes.append(
+                    st.session_state.label_id, *box, thumbnail)
                
         st.session_state.processed_object_count = len(objects)
         st.divider()
         
         # Build the HTML table
-        if st.session_state.annotation_df.empty: 
+        if not st.session_state.annotation_boxes: 
             st.write("No annotations yet.") 
         else: 
-            table_html = build_html_table(st.session_state.annotation_df) 
+            with timed("build_html_table"):
+                table_html = build_html_table(st.session_state.annotation_boxes)
             # Display the table with unsafe_allow_html=True 
             st.markdown(table_html, unsafe_allow_html=True)
             
             # Button to remove the last annotation
             if st.button("Remove Last Annotation", type="primary"):
-                # Remove the last row from the annotation dataframe and redraw the UI
-                if not st.session_state.annotation_df.empty:
-                    st.session_state.annotation_df.drop(st.session_state.annotation_df.index[-1], inplace=True)
+                # Remove the last box from the annotation buffer and redraw the UI
+                if st.session_state.annotation_boxes:
+                    st.session_state.annotation_boxes.pop()
                     st.rerun()
 
-def set_theme():
-    # Detect which theme is being used
-    # FIXME: This is not an elegant solution
+@st.cache_data(show_spinner=False)
+def render_css(theme, custom_css=None):
+    """
+    Render the css style template with the theme colors (memoized per process).
+    :param theme: The base theme ("light" or "dark")
+    :param custom_css: Additional css of the page
+    :return: The <style> block or None if the template was not found
+    """
+    theme_colors = colormap_dark if theme == "dark" else colormap_light
+    css_path = os.path.join(os.path.dirname(__file__), "style_template.css")
+    if not os.path.exists(css_path):
+        return None
+    with open(css_path, "r") as f:
+        css_template = f.read()
+    css = css_template.format(**theme_colors)
+    if custom_css:
+        css += custom_css
+    return f"<style>{css}</style>"
+
+
+def detect_theme():
+    """
+    Detect the theme of the browser and keep it in the session state.
+    The theme component is mounted once per session (stable key) and only reports
+    back to the server, triggering a rerun, when the theme changes.
+    """
+    if "theme" not in st.session_state:
+        st.session_state.theme = "light"
     try:
-        theme = st_theme()["base"]
-        theme_colors = colormap_light if theme == "light" else colormap_dark
-    except:
-        theme_colors = colormap_light
+        theme = st_theme(key="theme_detector")["base"]
+    except (TypeError, KeyError):
+        # The component has not reported the theme yet
+        return st.session_state.theme
+    if theme != st.session_state.theme:
+        st.session_state.theme = theme
+    return theme
 
-    # Read the css style template and set the theme colors
-    css_path = os.path.join(os.path.dirname(__file__), "style_template.css")
-    if os.path.exists(css_path):
-        with open(css_path, "r") as f:
-            css_template = f.read()
-        css = css_template.format(**theme_colors)
-        st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
+
+def set_theme(custom_css=None):
+    css = render_css(detect_theme(), custom_css)
+    if css is not None:
+        st.markdown(css, unsafe_allow_html=True)
     else:
         st.warning("CSS template not found. Please check the path.")
         
+
+def debug_panel_enabled():
+    return PERF_DEBUG or st.query_params.get("debug") == "1"
+
+
+def record_rerun_metrics(page):
+    """
+    Export the metrics after a rerun (throttled).
+    The memory gauges walk the session state, so they are only measured when the metrics are
+    exported or shown in the debug panel, not on every rerun.
+    """
+    export = PERF_METRICS.export_due()
+    if export or debug_panel_enabled():
+        PERF_METRICS.set_gauge("session_state_bytes", session_state_bytes(st.session_state), page=page)
+        PERF_METRICS.set_gauge("process_rss_bytes", process_rss_bytes())
+    if export:
+        try:
+            PERF_METRICS.write(METRICS_PATH)
+        except OSError as e:
+            print(f"Error exporting metrics: {e}")
+
+
+def create_debug_panel(page):
+    """
+    Show the rerun latencies of the page and the memory usage in the sidebar.
+    """
+    with st.sidebar.expander("Performance", expanded=False):
+        rows = "\n".join(
+            f"| {phase} | {stats['last_ms']} | {stats['p50_ms']} | {stats['p95_ms']} | {stats['count']} |"
+            for phase, stats in PERF_METRICS.snapshot(page).items())
+        st.markdown("| Phase | Last (ms) | p50 (ms) | p95 (ms) | Count |\n|---|---|---|---|---|\n" + rows)
+        state_bytes = PERF_METRICS.gauge("session_state_bytes", page=page) or 0
+        rss_bytes = PERF_METRICS.gauge("process_rss_bytes") or 0
+        st.markdown(f"Session state: **{state_bytes / 1024:.1f} KB**, process RSS: **{rss_bytes / 1024 ** 2:.1f} MB**")
+
+
 # Main annotation function
 def annotation_page(title, labels, custom_css=None):
     st.set_page_config(layout="wide", page_title=title)
+    # Identifies the page in the performance metrics
+    st.session_state.page_title = title
     st.session_state.current_labels = labels["Danish"]
     
-    set_theme()
-    
-    if custom_css:
-        st.markdown(f"<style>{custom_css}</style>", unsafe_allow_html=True)
-    
-    # ===============================================================
-    # SIDEBAR
-    # ===============================================================
-    create_sidebar(labels)
-                
-    # ===============================================================
-    # MAIN PAGE
-    # =============================================================== 
-    create_main_page()
\ No newline at end of file
+    try:
+        with timed("rerun"):
+            report_saves()
+            with timed("set_theme"):
+                set_theme(custom_css)
+            
+            # Before the sidebar, as the claim decides if the image can be submitted
+            renew_claim()
+
+            # ===============================================================
+            # SIDEBAR
+            # ===============================================================
+            with timed("create_sidebar"):
+                create_sidebar(labels)
+                        
+            # ===============================================================
+            # MAIN PAGE
+            # =============================================================== 
+            create_main_page()
+    finally:
+        # Also recorded when the rerun is interrupted (st.rerun / st.stop)
+        record_rerun_metrics(title)
+
+    if debug_panel_enabled():
+        create_debug_panel(title)
\ No newline at end of file
@@ -1,12 +1,276 @@
 import os
+import sys
 import json
+import sqlite3
+import time
+import threading
+from contextlib import contextmanager
 from abc import ABC, abstractmethod
 
+from atomic_files import atomic_write
+
+
+# One journal per database file, shared by all the sessions of the process
+_JOURNALS = {}
+_JOURNALS_LOCK = threading.Lock()
+
+# How long an annotator keeps the claim on an image without any activity
+DEFAULT_LEASE_SECONDS = 15 * 60
+
+
+def get_journal(save_folder):
+    """
+    Get the (process-wide) annotation journal stored in the given folder.
+    """
+    with _JOURNALS_LOCK:
+        if save_folder not in _JOURNALS:
+            if not os.path.exists(save_folder):
+                os.makedirs(save_folder)
+            _JOURNALS[save_folder] = AnnotationJournal(os.path.join(save_folder, "annotations.db"))
+        return _JOURNALS[save_folder]
+
+
+class AnnotationJournal:
+    """
+    Append-only store of the submitted annotations, backed by SQLite in WAL mode.
+    Every submit only writes the rows of the submitted image, and a crash during a
+    write never corrupts the annotations submitted before. The final COCO JSON is
+    produced on demand with export_coco().
+
+    The journal is safe to share between concurrent annotators (threads or processes).
+    Images are identified by their file name and handed out with time-limited claims,
+    so that two annotators never work on the same image at the same time.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly (see _transaction)
+        self.connection = sqlite3.connect(
+            db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_name TEXT NOT NULL UNIQUE,
+                    width INTEGER,
+                    height INTEGER,
+                    annotator TEXT
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS annotations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    image_id INTEGER NOT NULL,
+                    category_id INTEGER NOT NULL,
+                    bbox TEXT NOT NULL,
+                    area REAL NOT NULL,
+                    iscrowd INTEGER NOT NULL DEFAULT 0
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS annotations_image_id ON annotations (image_id)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS claims (
+                    file_name TEXT PRIMARY KEY,
+                    annotator TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )""")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the reads inside the
+        # transaction cannot be invalidated by another writer
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def append(self, images, annotations, annotator=None):
+        """
+        Write the given images and their annotations in a single transaction.
+        Re-submitting an image replaces its previous annotations, and the claims of the
+        submitted images are released.
+        :param images: A list of COCO image dicts (identified by their file name)
+        :param annotations: A list of COCO annotation dicts
+        :param annotator: The annotator submitting the images (optional). The write is refused
+            unless the annotator still holds the claim on every image, or submitted it before.
+        :raise RuntimeError: If another annotator took over one of the images
+        """
+        with self._transaction():
+            if annotator is not None:
+                # Checked in the write transaction, as the claim can expire and be taken over
+                # by another annotator while the write is queued
+                for image in images:
+                    if not self._holds(image["file_name"], annotator):
+                        raise RuntimeError(f"{image['file_name']} was taken over by another annotator")
+            image_ids = {}
+            for image in images:
+                self.connection.execute("""
+                    INSERT INTO images (file_name, width, height, annotator) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (file_name) DO UPDATE SET
+                        width = excluded.width, height = excluded.height, annotator = excluded.annotator""",
+                    (image["file_name"], image.get("width"), image.get("height"), annotator))
+                image_id = self.connection.execute(
+                    "SELECT id FROM images WHERE file_name = ?", (image["file_name"],)).fetchone()[0]
+                image_ids[image["id"]] = image_id
+                self.connection.execute("DELETE FROM annotations WHERE image_id = ?", (image_id,))
+                self.connection.execute("DELETE FROM claims WHERE file_name = ?", (image["file_name"],))
+            # The image and annotation ids are assigned by the journal, so they are unique across sessions
+            self.connection.executemany(
+                "INSERT INTO annotations (image_id, category_id, bbox, area, iscrowd) VALUES (?, ?, ?, ?, ?)",
+                [(image_ids[annotation["image_id"]], annotation["category_id"], json.dumps(annotation["bbox"]),
+                  annotation["area"], annotation["iscrowd"]) for annotation in annotations])
+
+    def _holds(self, file_name, annotator):
+        # The annotator's own claim (even expired, as long as nobody took it over), or their own
+        # submission if they revisit the image without a claim
+        claim = self.connection.execute(
+            "SELECT annotator FROM claims WHERE file_name = ?", (file_name,)).fetchone()
+        if claim is not None:
+            return claim[0] == annotator
+        image = self.connection.execute(
+            "SELECT annotator FROM images WHERE file_name = ?", (file_name,)).fetchone()
+        return image is not None and image[0] == annotator
+
+    def claim(self, file_name, annotator, lease_seconds=DEFAULT_LEASE_SECONDS, allow_completed=False):
+        """
+        Claim an image for an annotator, or renew the annotator's existing claim.
+        :param allow_completed: Also claim an image which was already submitted (to revisit and re-submit it)
+        :return: True if the image is claimed by the annotator, False if another annotator holds it
+            or (unless allow_completed) it was already submitted
+        """
+        now = time.time()
+        with self._transaction():
+            # Checked in the claim transaction, as the image can be submitted after the caller
+            # listed the completed images (e.g. in claim_next)
+            if not allow_completed and self.connection.execute(
+                    "SELECT 1 FROM images WHERE file_name = ?", (file_name,)).fetchone():
+                return False
+            cursor = self.connection.execute("""
+                INSERT INTO claims (file_name, annotator, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (file_name) DO UPDATE SET
+                    annotator = excluded.annotator, expires_at = excluded.expires_at
+                WHERE claims.annotator = excluded.annotator OR claims.expires_at < ?""",
+                (file_name, annotator, now + lease_seconds, now))
+            return cursor.rowcount > 0
+
+    def claim_next(self, file_names, annotator, start=0, lease_seconds=DEFAULT_LEASE_SECONDS, exclude=()):
+        """
+        Claim the first image from the given position on which is neither annotated
+        nor claimed by another annotator. The search wraps around to the beginning of the queue,
+        so skipped images and images whose claims expired are offered again.
+        :param file_names: The ordered file names of the annotator's queue
+        :param start: The position in the queue to start searching from
+        :param exclude: Positions not to claim (e.g. the image the annotator just left)
+        :return: The position of the claimed image or None if no image is left
+        """
+        completed = self.completed_file_names()
+        claimed = self.claimed_file_names(exclude_annotator=annotator)
+        start = min(start, len(file_names))
+        for index in [*range(start, len(file_names)), *range(start)]:
+            if index in exclude:
+                continue
+            file_name = file_names[index]
+            if file_name in completed or file_name in claimed:
+                continue
+            # The claim can still fail if another annotator was faster
+            if self.claim(file_name, annotator, lease_seconds):
+                return index
+        return None
+
+    def release(self, file_name, annotator):
+        """
+        Release the annotator's claim on an image.
+        """
+        with self._transaction():
+            self.connection.execute(
+                "DELETE FROM claims WHERE file_name = ? AND annotator = ?", (file_name, annotator))
+
+    def image_annotations(self, file_name):
+        """
+        Get the saved annotations of a submitted image.
+        :return: A list of (category_id, bbox) tuples, empty if the image was not submitted
+        """
+        with self._lock:
+            rows = self.connection.execute("""
+                SELECT annotations.category_id, annotations.bbox FROM annotations
+                JOIN images ON images.id = annotations.image_id
+                WHERE images.file_name = ? ORDER BY annotations.id""", (file_name,)).fetchall()
+        return [(category_id, json.loads(bbox)) for category_id, bbox in rows]
+
+    def completed_file_names(self):
+        """
+        Get the file names of all the submitted images.
+        """
+        with self._lock:
+            rows = self.connection.execute("SELECT file_name FROM images").fetchall()
+        return {row[0] for row in rows}
+
+    def claimed_file_names(self, exclude_annotator=None):
+        """
+        Get the file names of the images with an active claim.
+        :param exclude_annotator: Ignore the claims of this annotator
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT file_name FROM claims WHERE expires_at >= ? AND annotator IS NOT ?",
+                (time.time(), exclude_annotator)).fetchall()
+        return {row[0] for row in rows}
+
+    def remaining_count(self, file_names):
+        """
+        Count the images which have not been submitted yet.
+        :param file_names: The file names of all the images of the task
+        """
+        return len(set(file_names) - self.completed_file_names())
+
+    def export_coco(self, categories):
+        """
+        Compact the journal into a COCO-style dict.
+        :param categories: The list of COCO categories
+        """
+        with self._lock:
+            images = self.connection.execute(
+                "SELECT id, file_name, width, height FROM images ORDER BY id").fetchall()
+            annotations = self.connection.execute(
+                "SELECT id, image_id, category_id, bbox, area, iscrowd FROM annotations ORDER BY id").fetchall()
+
+        coco_images = []
+        for image_id, file_name, width, height in images:
+            image_dict = {"id": image_id, "file_name": file_name}
+            if width is not None:
+                image_dict["width"] = width
+                image_dict["height"] = height
+            coco_images.append(image_dict)
+
+        return {
+            "images": coco_images,
+            "annotations": [{
+                "id": annotation_id,
+                "image_id": image_id,
+                "category_id": category_id,
+                "bbox": json.loads(bbox),
+                "area": area,
+                "iscrowd": iscrowd
+            } for annotation_id, image_id, category_id, bbox, area, iscrowd in annotations],
+            "categories": categories
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
 
 class Annotations(ABC):
     
     def __init__(self, type):
         self.type = type
+        # Images and annotations added since the last save
         self.images = []
         self.annotations = []
         self.categories = self.initialize_categories()
@@ -35,23 +299,53 @@ class Annotations(ABC):
             "iscrowd": 0
         })
     
-    def save_annotations(self, save_path):
-        save_folder = os.path.join(save_path, self.type)
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-            
+    def pop_pending(self):
+        """
+        Take the images and annotations added since the last save (e.g. to save them in the background).
+        :return: The lists of images and annotations
+        """
+        images, annotations = self.images, self.annotations
+        self.images = []
+        self.annotations = []
+        return images, annotations
+
+    def get_journal(self, save_path):
+        """
+        Get the annotation journal of this annotation type in the given folder.
+        """
+        return get_journal(os.path.join(save_path, self.type))
+
+    def save_annotations(self, save_path, annotator=None):
+        """
+        Append the images and annotations added since the last save to the journal.
+        :param annotator: The annotator submitting the annotations (releases their claims)
+        :return: True if the annotations were saved successfully
+        """
         try:
-            with open(save_folder + "/annotations.json", "w") as f:
-                json.dump({
-                    "images": self.images,
-                    "annotations": self.annotations,
-                    "categories": self.categories
-                }, f, indent=4)  # Add indentation for readability
+            self.get_journal(save_path).append(self.images, self.annotations, annotator=annotator)
+            self.images = []
+            self.annotations = []
             return True
         except Exception as e:
             print(f"Error saving annotations: {e}")
             return False
 
+    def export_annotations(self, save_path):
+        """
+        Export all the saved annotations to annotations.json in the COCO format.
+        :return: True if the annotations were exported successfully
+        """
+        try:
+            coco_data = self.get_journal(save_path).export_coco(self.categories)
+            json_path = os.path.join(save_path, self.type, "annotations.json")
+            # A crash never corrupts the previous export
+            with atomic_write(json_path) as f:
+                json.dump(coco_data, f, indent=4)  # Add indentation for readability
+            return True
+        except Exception as e:
+            print(f"Error exporting annotations: {e}")
+            return False
+
 
 class ToothNumberAnnotations(Annotations):
     
@@ -86,4 +380,13 @@ class AnnomalyAnnotations(Annotations):
                 "name": anomalies[i],
                 "supercategory": "anomaly"
             })
-        return categories
\ No newline at end of file
+        return categories
+
+
+if __name__ == "__main__":
+    # Export the annotation journals to COCO JSON, e.g.: python annotations.py output
+    save_path = sys.argv[1] if len(sys.argv) > 1 else "output"
+    for coco_annotations in (ToothNumberAnnotations(), AnnomalyAnnotations()):
+        if os.path.exists(os.path.join(save_path, coco_annotations.type, "annotations.db")):
+            if coco_annotations.export_annotations(save_path):
+                print(f"Exported {coco_annotations.type} annotations.")
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+"""
+Atomic file writes: the content is written to a temporary file (or folder) next to the
+destination, which is only moved into place once complete. A crash never leaves a partial
+file behind, and concurrent writers (threads or processes) each get their own temporary name.
+"""
+
+
+def _temporary_name(path):
+    folder, name = os.path.split(path)
+    return folder or ".", f".{name}.", ".tmp"
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Get the path of a temporary file to write, moved to the given path when the block succeeds.
+    Used for writers which need a path (e.g. PIL or numpy), see atomic_write for a file object.
+    """
+    folder, prefix, suffix = _temporary_name(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=prefix, suffix=suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Open a temporary file for writing, moved to the given path when the block succeeds.
+    :param mode: The mode to open the file in ("w" or "wb")
+    """
+    with atomic_path(path) as tmp_path, open(tmp_path, mode) as f:
+        yield f
+
+
+@contextmanager
+def atomic_folder(path):
+    """
+    Get a temporary folder to fill, moved to the given path when the block succeeds.
+    If the folder was created concurrently by another writer, the temporary folder is discarded.
+    """
+    folder, prefix, suffix = _temporary_name(path)
+    tmp_folder = tempfile.mkdtemp(dir=folder, prefix=prefix, suffix=suffix)
+    try:
+        yield tmp_folder
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_folder, path)
+    except OSError:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
@@ -0,0 +1,83 @@
+from array import array
+
+"""
+Compact buffer of the bounding boxes drawn on the current image.
+Replaces a pandas DataFrame which was reallocated on every insert and scanned on every rerun.
+"""
+
+
+class BoxBuffer:
+    """
+    Column-wise, array-backed storage of the in-progress annotations of an image.
+    A hash index on (x_min, y_min, width, height) makes duplicate checks O(1).
+    """
+    __slots__ = ("labels", "x_min", "y_min", "width", "height", "crops", "_index")
+
+    def __init__(self):
+        self.labels = array("i")
+        self.x_min = array("d")
+        self.y_min = array("d")
+        self.width = array("d")
+        self.height = array("d")
+        # References to the cropped images of the boxes
+        self.crops = []
+        # Maps (x_min, y_min, width, height) to the position of the box
+        self._index = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __bool__(self):
+        return len(self.labels) > 0
+
+    def __iter__(self):
+        """
+        Iterate over the boxes as (label, x_min, y_min, width, height, crop) tuples.
+        """
+        return zip(self.labels, self.x_min, self.y_min, self.width, self.height, self.crops)
+
+    def contains(self, x_min, y_min, width, height):
+        """
+        Check if a box with the given coordinates already exists.
+        """
+        return (x_min, y_min, width, height) in self._index
+
+    def append(self, label, x_min, y_min, width, height, crop=None):
+        """
+        Add a box to the buffer.
+        :return: False if a box with the same coordinates already exists
+        """
+        key = (x_min, y_min, width, height)
+        if key in self._index:
+            return False
+        self._index[key] = len(self.labels)
+        self.labels.append(label)
+        self.x_min.append(x_min)
+        self.y_min.append(y_min)
+        self.width.append(width)
+        self.height.append(height)
+        self.crops.append(crop)
+        return True
+
+    def pop(self):
+        """
+        Remove the last box from the buffer.
+        """
+        if not self.labels:
+            raise IndexError("pop from an empty BoxBuffer")
+        del self._index[(self.x_min[-1], self.y_min[-1], self.width[-1], self.height[-1])]
+        for column in (self.labels, self.x_min, self.y_min, self.width, self.height, self.crops):
+            column.pop()
+
+    def delete(self, position):
+        """
+        Remove the box at the given position from the buffer.
+        """
+        for column in (self.labels, self.x_min, self.y_min, self.width, self.height, self.crops):
+            del column[position]
+        # The positions after the deleted box have shifted
+        self._index = {
+            key: i for i, key in enumerate(zip(self.x_min, self.y_min, self.width, self.height))}
+
+    def clear(self):
+        self.__init__()
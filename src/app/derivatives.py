@@ -0,0 +1,105 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from atomic_files import atomic_path
+
+"""
+On-disk store of precomputed image derivatives (e.g. the canvas-size renders of the images).
+Each derivative is built once, either in the background or on first access, and saved next
+to the dataset so that the reruns of the app only have to load a small, ready-made image.
+"""
+
+
+_BUILD_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="derivative-build")
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_derivative_store(root, size):
+    """
+    Get the (process-wide) derivative store for the given directory and canvas size.
+    """
+    with _STORES_LOCK:
+        key = (root, size)
+        if key not in _STORES:
+            _STORES[key] = DerivativeStore(root, size)
+        return _STORES[key]
+
+
+class DerivativeStore:
+    """
+    Builds and stores square, LANCZOS-resized renders of the source images.
+    Derivatives are named after a hash of the source path and modification time,
+    so a changed source image gets a new derivative.
+    """
+    def __init__(self, root, size):
+        """
+        :param root: The directory where the derivatives are saved
+        :param size: The width and height of the derivatives
+        """
+        self.size = size
+        self.folder = os.path.join(root, f"canvas_{size}")
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self._scheduled = set()
+        self._lock = threading.Lock()
+
+    def path_for(self, source_path):
+        """
+        Get the path of the derivative of a source image.
+        """
+        stat = os.stat(source_path)
+        digest = hashlib.sha1(
+            f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}".encode()).hexdigest()
+        return os.path.join(self.folder, f"{digest}.png")
+
+    def build(self, source_path, image=None):
+        """
+        Build the derivative of a source image and save it to disk.
+        :param source_path: The path of the source image
+        :param image: The already decoded source image (optional)
+        :return: The derivative image
+        """
+        if image is None:
+            with Image.open(source_path) as img:
+                image = img.convert("RGB")
+        derivative = image.resize((self.size, self.size), Image.LANCZOS)
+
+        with atomic_path(self.path_for(source_path)) as tmp_path:
+            derivative.save(tmp_path, format="PNG")
+        return derivative
+
+    def load(self, source_path, loader=None):
+        """
+        Load the derivative of a source image, building it if it does not exist yet.
+        :param source_path: The path of the source image
+        :param loader: A function without arguments returning the decoded source image (optional)
+        :return: The derivative image
+        """
+        path = self.path_for(source_path)
+        if os.path.exists(path):
+            with Image.open(path) as img:
+                return img.convert("RGB")
+        return self.build(source_path, loader() if loader else None)
+
+    def build_in_background(self, source_paths):
+        """
+        Schedule the missing derivatives to be built in the background.
+        Every source image is scheduled at most once per process.
+        """
+        with self._lock:
+            source_paths = [path for path in source_paths if path not in self._scheduled]
+            self._scheduled.update(source_paths)
+        for source_path in source_paths:
+            _BUILD_EXECUTOR.submit(self._build_if_missing, source_path)
+
+    def _build_if_missing(self, source_path):
+        try:
+            if not os.path.exists(self.path_for(source_path)):
+                self.build(source_path)
+        except Exception as e:
+            print(f"Error building derivative of {source_path}: {e}")
@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+"""
+A process-wide cache of decoded images, shared by all Streamlit sessions.
+Images are keyed by their path, modification time and variant (e.g. the original
+image or a canvas render), and the least recently used images are evicted once
+the total size exceeds the byte budget.
+"""
+
+
+# Default budget of the shared cache, can be overridden with the IMAGE_CACHE_MAX_BYTES environment variable
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Bytes per pixel of the PIL modes stored in less than 32 bits (e.g. RGB is stored as 4 bytes per pixel)
+_PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2, "I;16N": 2}
+
+
+def image_nbytes(image):
+    """
+    Estimate the memory used by a decoded PIL image.
+    """
+    return image.width * image.height * _PIXEL_BYTES.get(image.mode, 4)
+
+
+class SharedImageCache:
+    """
+    A thread-safe, byte-budgeted LRU cache of decoded PIL images.
+    Concurrent requests for the same image wait for a single decode instead of decoding it again.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._images = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, variant="original"):
+        """
+        Build the cache key of an image file. Includes the modification time so that
+        a changed file is decoded again.
+        """
+        return (path, os.stat(path).st_mtime_ns, variant)
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def get(self, key):
+        """
+        Get an image from the cache.
+        :return: The cached image or None if it is not cached
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        """
+        Add an image to the cache and evict the least recently used images if the budget is exceeded.
+        """
+        nbytes = image_nbytes(image)
+        with self._lock:
+            if key in self._images:
+                self.current_bytes -= image_nbytes(self._images.pop(key))
+            # Images larger than the whole budget are not cached
+            if nbytes > self.max_bytes:
+                return
+            self._images[key] = image
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.current_bytes -= image_nbytes(evicted)
+
+    def get_or_load(self, key, loader):
+        """
+        Get an image from the cache or load it with the given function.
+        :param key: The cache key (see make_key)
+        :param loader: A function without arguments returning the PIL image
+        :return: The image
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[key] = future
+
+        # Another thread is already loading this image
+        if not owner:
+            return future.result()
+
+        try:
+            image = loader()
+            self.put(key, image)
+            future.set_result(image)
+            return image
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.current_bytes = 0
+
+
+SHARED_IMAGE_CACHE = SharedImageCache(
+    int(os.getenv("IMAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
@@ -0,0 +1,135 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from image_cache import SHARED_IMAGE_CACHE
+
+"""
+Lazy image sources for the annotation pages.
+Only the image file paths are indexed up front, the images themselves are decoded
+on demand when they are displayed and kept in the process-wide image cache.
+"""
+
+
+# Shared between all sessions, so the number of prefetch threads does not grow with the number of annotators
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("IMAGE_PREFETCH_WORKERS", 4)), thread_name_prefix="image-prefetch")
+
+
+def index_image_paths(image_dir):
+    """
+    List the image files in a directory (sorted, so that the indices are stable between sessions).
+    :param image_dir: The directory to index
+    :return: A list of image file paths
+    """
+    extensions = Image.registered_extensions()
+    paths = []
+    for file_name in sorted(os.listdir(image_dir)):
+        path = os.path.join(image_dir, file_name)
+        if os.path.isfile(path) and os.path.splitext(file_name)[1].lower() in extensions:
+            paths.append(path)
+    return paths
+
+
+def decode_image(path):
+    """
+    Open an image file and convert it to RGB.
+    :param path: The path of the image file
+    :return: The decoded PIL image
+    """
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+class LazyImageSource:
+    """
+    A list-like collection of images which are decoded on demand.
+
+    The decoded images live in the shared image cache, so sessions annotating the same
+    images share a single copy. Whenever an image is requested, its neighbours are
+    decoded in the background so that moving to the next/previous image does not
+    have to wait for the decoding.
+    """
+    def __init__(self, image_dir, prefetch=1, cache=SHARED_IMAGE_CACHE, derivatives=None):
+        """
+        :param image_dir: The directory containing the images
+        :param prefetch: The number of images before and after the requested one to decode in the background
+        :param cache: The cache holding the decoded images
+        :param derivatives: The DerivativeStore with the precomputed canvas renders (optional)
+        """
+        self.image_dir = image_dir
+        self.paths = index_image_paths(image_dir)
+        self.prefetch = prefetch
+        self.cache = cache
+        self.derivatives = derivatives
+        if derivatives is not None:
+            derivatives.build_in_background(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __sizeof__(self):
+        # Only the index belongs to the source, the decoded images live in the shared cache
+        return object.__sizeof__(self) + sys.getsizeof(self.paths) + sum(sys.getsizeof(path) for path in self.paths)
+
+    def __getitem__(self, index):
+        index = self._check_index(index)
+        image = self._load(index)
+        self._prefetch_neighbours(index)
+        return image
+
+    def path(self, index):
+        """
+        Get the file path of the image at the given index.
+        """
+        return self.paths[index]
+
+    def canvas_image(self, index, size):
+        """
+        Get the image at the given index resized to the (square) canvas size.
+        :param index: The index of the image
+        :param size: The width and height of the canvas
+        :return: The resized PIL image
+        """
+        index = self._check_index(index)
+        path = self.paths[index]
+        if self.derivatives is not None and self.derivatives.size == size:
+            loader = lambda: self.derivatives.load(path, lambda: self._load(index))
+        else:
+            loader = lambda: self._load(index).resize((size, size), Image.LANCZOS)
+        return self.cache.get_or_load(self.cache.make_key(path, ("canvas", size)), loader)
+
+    def prefetch_indices(self, indices, canvas_size=None):
+        """
+        Decode the given images in the background, in the given order (most urgent first).
+        Images which are already cached are not decoded again.
+        :param indices: The indices of the images
+        :param canvas_size: Prepare the canvas renders of this size instead of the original images
+        """
+        for index in indices:
+            if canvas_size is None:
+                _PREFETCH_EXECUTOR.submit(self._load, self._check_index(index))
+            else:
+                _PREFETCH_EXECUTOR.submit(self.canvas_image, index, canvas_size)
+
+    def _check_index(self, index):
+        if index < 0:
+            index += len(self.paths)
+        if not 0 <= index < len(self.paths):
+            raise IndexError("Image index out of range")
+        return index
+
+    def _load(self, index):
+        path = self.paths[index]
+        return self.cache.get_or_load(self.cache.make_key(path), lambda: decode_image(path))
+
+    def _prefetch_neighbours(self, index):
+        for offset in range(1, self.prefetch + 1):
+            for neighbour in (index + offset, index - offset):
+                if not 0 <= neighbour < len(self.paths):
+                    continue
+                if self.cache.make_key(self.paths[neighbour]) in self.cache:
+                    continue
+                _PREFETCH_EXECUTOR.submit(self._load, neighbour)
@@ -24,4 +24,4 @@ css = """
 
 coco_annotation = AnnomalyAnnotations()
 init_session_state(coco_annotation)
-annotation_page("Dental Numbering Annotation", LABELS, custom_css=css)
\ No newline at end of file
+annotation_page("Dental Anomalies Annotation", LABELS, custom_css=css)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import array
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from atomic_files import atomic_write
+
+"""
+Performance metrics of the Streamlit reruns, shared by all sessions of the process.
+The durations of the phases of a rerun (e.g. set_theme, st_canvas, submit) are kept per page
+in a bounded window, from which the p50/p95 latencies are computed. The metrics are exported
+periodically in the Prometheus text format, and can be shown in a debug panel of the sidebar.
+"""
+
+
+# Number of durations kept per page and phase for the quantiles
+DEFAULT_WINDOW = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "annotation_app"
+
+
+def process_rss_bytes():
+    """
+    Get the resident set size of the process.
+    Reads /proc on Linux, otherwise falls back to psutil (if installed) or the peak RSS.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Estimate the memory used by an object and everything it references.
+    Objects defining their own __sizeof__ (e.g. LazyImageSource) are not traversed further.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, array.array, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(deep_sizeof(item, seen) for item in obj)
+    if type(obj).__sizeof__ is not object.__sizeof__:
+        return size
+    if hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def session_state_bytes(session_state):
+    """
+    Estimate the memory used by the values of a session state.
+    """
+    seen = set()
+    return sum(deep_sizeof(value, seen) for _, value in session_state.items())
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items())
+
+
+class PhaseStats:
+    """
+    The durations (in seconds) of one phase of one page.
+    """
+    __slots__ = ("recent", "count", "total")
+
+    def __init__(self, window):
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.recent.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """
+        Get the quantile of the recent durations (nearest rank).
+        """
+        if not self.recent:
+            return 0.0
+        durations = sorted(self.recent)
+        return durations[min(int(q * len(durations)), len(durations) - 1)]
+
+
+class PerfMetrics:
+    """
+    Thread-safe store of the rerun phase durations and gauges (e.g. the session state size).
+    """
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self._phases = {}
+        self._gauges = {}
+        self._last_export = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, page, phase, seconds):
+        """
+        Record the duration of a phase of a rerun.
+        """
+        with self._lock:
+            stats = self._phases.get((page, phase))
+            if stats is None:
+                stats = self._phases[(page, phase)] = PhaseStats(self.window)
+            stats.add(seconds)
+
+    @contextmanager
+    def timer(self, page, phase):
+        """
+        Time the enclosed block as a phase of a rerun of the page.
+        Also records the duration when the block is interrupted (e.g. by st.rerun or st.stop).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(page, phase, time.perf_counter() - start)
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set the current value of a gauge (e.g. the process RSS).
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def snapshot(self, page):
+        """
+        Summarize the phases of a page.
+        :return: A dict of phase: {"count", "last_ms", "p50_ms", "p95_ms"}
+        """
+        with self._lock:
+            phases = {phase: stats for (stats_page, phase), stats in self._phases.items() if stats_page == page}
+            return {
+                phase: {
+                    "count": stats.count,
+                    "last_ms": round(stats.recent[-1] * 1000, 1),
+                    "p50_ms": round(stats.quantile(0.5) * 1000, 1),
+                    "p95_ms": round(stats.quantile(0.95) * 1000, 1),
+                }
+                for phase, stats in sorted(phases.items())
+            }
+
+    def gauge(self, name, **labels):
+        with self._lock:
+            return self._gauges.get((name, tuple(sorted(labels.items()))))
+
+    def to_prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        name = f"{METRIC_PREFIX}_phase_seconds"
+        lines = [
+            f"# HELP {name} Duration of the phases of the Streamlit reruns (quantiles over the last {self.window}).",
+            f"# TYPE {name} summary",
+        ]
+        with self._lock:
+            for (page, phase), stats in sorted(self._phases.items()):
+                labels = _labels(page=page, phase=phase)
+                for q in QUANTILES:
+                    lines.append(f'{name}{{{labels},quantile="{q}"}} {stats.quantile(q):.6f}')
+                lines.append(f"{name}_sum{{{labels}}} {stats.total:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {stats.count}")
+
+            gauge_names = sorted({gauge_name for gauge_name, _ in self._gauges})
+            for gauge_name in gauge_names:
+                lines.append(f"# TYPE {METRIC_PREFIX}_{gauge_name} gauge")
+                for (other_name, labels), value in sorted(self._gauges.items()):
+                    if other_name == gauge_name:
+                        labels = f"{{{_labels(**dict(labels))}}}" if labels else ""
+                        lines.append(f"{METRIC_PREFIX}_{gauge_name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export_due(self, min_interval=15.0):
+        """
+        Check if the metrics are due to be exported, and if so reserve the export for the caller.
+        Used to also collect the expensive gauges (e.g. the session state size) only once per export.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_export < min_interval:
+                return False
+            self._last_export = now
+            return True
+
+    def export(self, path, min_interval=15.0):
+        """
+        Write the metrics in the Prometheus text format, at most once per min_interval seconds.
+        :return: True if the metrics were written
+        """
+        if not self.export_due(min_interval):
+            return False
+        self.write(path)
+        return True
+
+    def write(self, path):
+        """
+        Write the metrics in the Prometheus text format.
+        The file is replaced atomically, so a scraper never reads a partial file.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with atomic_write(path) as f:
+            f.write(self.to_prometheus())
+
+
+# Metrics of all the sessions of this process
+PERF_METRICS = PerfMetrics()
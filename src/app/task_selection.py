@@ -1,5 +1,8 @@
 import streamlit as st
 
+from annotation_template import SAVE_PATH, list_image_file_names
+from annotations import ToothNumberAnnotations, AnnomalyAnnotations
+
 st.set_page_config(page_title="Annotation Tool", layout="centered")
 
 
@@ -7,12 +10,19 @@ st.title("Annotation Tool")
 
 st.write("### Select an annotation task:")
 
+# Live number of images left per task, read from the shared annotation journals
+file_names = list_image_file_names()
+remaining_numbering = ToothNumberAnnotations().get_journal(SAVE_PATH).remaining_count(file_names)
+remaining_anomalies = AnnomalyAnnotations().get_journal(SAVE_PATH).remaining_count(file_names)
+
 col1, col2 = st.columns(2)
 
 with col1:
-    if st.button("Dental Numbering", use_container_width=True):
+    if st.button("Dental Numbering", use_container_width=True, disabled=remaining_numbering == 0):
         st.switch_page("pages/dental_numbering.py")
+    st.markdown(f"<b>{remaining_numbering}</b> of <b>{len(file_names)}</b> images remaining", unsafe_allow_html=True)
 
 with col2:
-    if st.button("Anomaly Detection", use_container_width=True):
+    if st.button("Anomaly Detection", use_container_width=True, disabled=remaining_anomalies == 0):
         st.switch_page("pages/dental_anomalies.py")
+    st.markdown(f"<b>{remaining_anomalies}</b> of <b>{len(file_names)}</b> images remaining", unsafe_allow_html=True)
@@ -0,0 +1,108 @@
+import os
+import hashlib
+import threading
+
+from atomic_files import atomic_path
+
+"""
+Content-addressed thumbnails of the annotated crops.
+The thumbnails are encoded once and saved in the static folder of the app, so the
+annotation table only references them by URL instead of inlining the images.
+The least recently used thumbnails are evicted once the folder exceeds its byte budget.
+"""
+
+
+# Streamlit serves the files in the "static" folder next to the main script under "app/static"
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+THUMBNAIL_PATH = os.path.join(STATIC_PATH, "thumbnails")
+THUMBNAIL_URL = "app/static/thumbnails"
+
+# Maximum thumbnail size (twice the displayed height of 50px for high-DPI screens)
+THUMBNAIL_SIZE = (100, 100)
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_EXTENSION = "webp"
+# Byte budget of the thumbnail folder, can be overridden with the THUMBNAIL_MAX_BYTES environment variable
+THUMBNAIL_MAX_BYTES = int(os.environ.get("THUMBNAIL_MAX_BYTES", 64 * 1024 * 1024))
+
+# Total size of the thumbnails, computed on the first save
+_current_bytes = None
+_lock = threading.Lock()
+
+
+def thumbnail_key(image):
+    """
+    Compute the content hash of an image, used as the name of its thumbnail.
+    """
+    digest = hashlib.sha1(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def save_thumbnail(image):
+    """
+    Save the thumbnail of an image if it does not exist yet.
+    :param image: The PIL image
+    :return: The key of the thumbnail
+    """
+    key = thumbnail_key(image)
+    path = os.path.join(THUMBNAIL_PATH, f"{key}.{THUMBNAIL_EXTENSION}")
+    try:
+        # Update the modification time, used as the recency for the eviction
+        os.utime(path)
+        return key
+    except FileNotFoundError:
+        pass
+    if not os.path.exists(THUMBNAIL_PATH):
+        os.makedirs(THUMBNAIL_PATH, exist_ok=True)
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    # The browser never receives a partial thumbnail
+    with atomic_path(path) as tmp_path:
+        thumbnail.save(tmp_path, format=THUMBNAIL_FORMAT, quality=80)
+    _add_bytes(os.path.getsize(path))
+    return key
+
+
+def _entries():
+    for entry in os.scandir(THUMBNAIL_PATH):
+        if entry.name.endswith(f".{THUMBNAIL_EXTENSION}"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Evicted concurrently
+                continue
+            yield entry.path, stat.st_size, stat.st_mtime
+
+
+def _add_bytes(size):
+    global _current_bytes
+    with _lock:
+        if _current_bytes is None:
+            _current_bytes = sum(entry_size for _, entry_size, _ in _entries())
+        else:
+            _current_bytes += size
+        if _current_bytes > THUMBNAIL_MAX_BYTES:
+            _evict()
+
+
+def _evict():
+    # Called with the lock held. Removes the least recently used thumbnails until the folder uses
+    # at most 90% of THUMBNAIL_MAX_BYTES (the thumbnails of the boxes being annotated were used recently)
+    global _current_bytes
+    entries = sorted(_entries(), key=lambda entry: entry[2])
+    _current_bytes = sum(size for _, size, _ in entries)
+    for path, size, _ in entries:
+        if _current_bytes <= 0.9 * THUMBNAIL_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _current_bytes -= size
+
+
+def thumbnail_url(key):
+    """
+    Get the URL of a thumbnail.
+    """
+    return f"{THUMBNAIL_URL}/{key}.{THUMBNAIL_EXTENSION}"
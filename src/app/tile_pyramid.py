@@ -0,0 +1,240 @@
+import os
+import json
+import math
+import hashlib
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+from PIL import Image
+
+from image_cache import SHARED_IMAGE_CACHE
+from atomic_files import atomic_folder
+
+"""
+Deep-zoom tile pyramids of the source images, for annotating at full resolution.
+Every image is cut once into tiles at halving resolutions (DZI-like, level 0 being the full
+resolution) on the first zoom into it, as most images are never zoomed. A view of the image
+is composed from the few tiles of the best level for the zoom. The canvas therefore only ever
+receives a canvas-size render of the current view, however large the radiograph is.
+"""
+
+
+TILE_SIZE = 256
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_tile_store(root, tile_size=TILE_SIZE):
+    """
+    Get the (process-wide) tile store for the given directory and tile size.
+    """
+    with _STORES_LOCK:
+        key = (root, tile_size)
+        if key not in _STORES:
+            _STORES[key] = TileStore(root, tile_size)
+        return _STORES[key]
+
+
+def source_image_size(path):
+    """
+    Get the (width, height) of an image file, reading only its header.
+    """
+    return _image_size(path, os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=4096)
+def _image_size(path, mtime_ns):
+    # Keyed by the modification time, so a changed file is read again
+    with Image.open(path) as img:
+        return img.size
+
+
+class Viewport(namedtuple("Viewport", ["x", "y", "width", "height", "size"])):
+    """
+    A region of the original image (in original pixels) shown on the square canvas of the given size.
+    """
+    __slots__ = ()
+
+    def to_original(self, x, y, width, height):
+        """
+        Map a box from canvas coordinates to the pixel coordinates of the original image.
+        """
+        scale_x, scale_y = self.width / self.size, self.height / self.size
+        return self.x + x * scale_x, self.y + y * scale_y, width * scale_x, height * scale_y
+
+    def to_canvas(self, x, y, width, height):
+        """
+        Map a box from the pixel coordinates of the original image to canvas coordinates.
+        """
+        scale_x, scale_y = self.size / self.width, self.size / self.height
+        return (x - self.x) * scale_x, (y - self.y) * scale_y, width * scale_x, height * scale_y
+
+    def intersects(self, x, y, width, height):
+        """
+        Check if a box (in original pixel coordinates) is at least partly visible.
+        """
+        return x < self.x + self.width and x + width > self.x and y < self.y + self.height and y + height > self.y
+
+
+def make_viewport(image_size, canvas_size, zoom=1.0, center=(0.5, 0.5)):
+    """
+    Compute the region of the image shown at the given zoom.
+    At zoom 1 the whole image is shown, like the canvas-size derivative.
+    :param image_size: The (width, height) of the original image
+    :param canvas_size: The width and height of the canvas
+    :param zoom: The zoom factor (at least 1)
+    :param center: The center of the view, in coordinates normalized to [0, 1]
+    :return: A Viewport kept inside the image
+    """
+    image_width, image_height = image_size
+    zoom = max(zoom, 1.0)
+    width, height = image_width / zoom, image_height / zoom
+    x = min(max(center[0] * image_width - width / 2, 0.0), image_width - width)
+    y = min(max(center[1] * image_height - height / 2, 0.0), image_height - height)
+    return Viewport(x, y, width, height, canvas_size)
+
+
+class TileStore:
+    """
+    Builds and stores the tile pyramids of the source images.
+    A pyramid is a folder named after a hash of the source path and modification time, with one
+    subfolder of <column>_<row>.png tiles per level and a pyramid.json describing the levels.
+    """
+    def __init__(self, root, tile_size=TILE_SIZE):
+        """
+        :param root: The directory where the pyramids are saved
+        :param tile_size: The width and height of the tiles
+        """
+        self.tile_size = tile_size
+        self.folder = os.path.join(root, f"tiles_{tile_size}")
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def pyramid_folder(self, source_path):
+        """
+        Get the folder of the pyramid of a source image.
+        """
+        stat = os.stat(source_path)
+        digest = hashlib.sha1(
+            f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}".encode()).hexdigest()
+        return os.path.join(self.folder, digest)
+
+    def info(self, source_path):
+        """
+        Get the description of the pyramid of a source image.
+        :return: A dict with the "width", "height", "tile_size" and the [width, height] of the "levels",
+            or None if the pyramid has not been built yet
+        """
+        try:
+            with open(os.path.join(self.pyramid_folder(source_path), "pyramid.json"), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def build(self, source_path, image=None):
+        """
+        Build the pyramid of a source image and save it to disk.
+        :param source_path: The path of the source image
+        :param image: The already decoded source image (optional)
+        :return: The description of the pyramid (see info)
+        """
+        if image is None:
+            with Image.open(source_path) as img:
+                image = img.convert("RGB")
+
+        # Built in a temporary folder, so a crash never leaves a partial pyramid behind
+        with atomic_folder(self.pyramid_folder(source_path)) as tmp_folder:
+            levels = []
+            level_image = image
+            while True:
+                levels.append(list(level_image.size))
+                level_folder = os.path.join(tmp_folder, str(len(levels) - 1))
+                os.makedirs(level_folder)
+                width, height = level_image.size
+                for row in range(math.ceil(height / self.tile_size)):
+                    for col in range(math.ceil(width / self.tile_size)):
+                        box = (col * self.tile_size, row * self.tile_size,
+                               min((col + 1) * self.tile_size, width), min((row + 1) * self.tile_size, height))
+                        level_image.crop(box).save(os.path.join(level_folder, f"{col}_{row}.png"), format="PNG")
+                if max(width, height) <= self.tile_size:
+                    break
+                # Halve the resolution (a box filter is enough for a factor of 2, and fast)
+                level_image = level_image.reduce(2)
+
+            info = {"width": image.width, "height": image.height, "tile_size": self.tile_size, "levels": levels}
+            with open(os.path.join(tmp_folder, "pyramid.json"), "w") as f:
+                json.dump(info, f)
+        return info
+
+    def ensure(self, source_path, loader=None):
+        """
+        Get the description of the pyramid of a source image, building the pyramid if needed.
+        :param loader: A function without arguments returning the decoded source image (optional)
+        """
+        info = self.info(source_path)
+        if info is not None:
+            return info
+        with self._lock:
+            build_lock = self._build_locks.setdefault(source_path, threading.Lock())
+        # Concurrent requests for the same image wait for a single build
+        with build_lock:
+            try:
+                info = self.info(source_path)
+                if info is None:
+                    info = self.build(source_path, loader() if loader else None)
+            finally:
+                # Later requests find the pyramid on disk, so the lock is not kept for every zoomed image
+                with self._lock:
+                    if self._build_locks.get(source_path) is build_lock:
+                        del self._build_locks[source_path]
+        return info
+
+    def tile(self, source_path, level, col, row):
+        """
+        Load a tile of the pyramid of a source image (cached in the shared image cache).
+        """
+        path = os.path.join(self.pyramid_folder(source_path), str(level), f"{col}_{row}.png")
+
+        def load():
+            with Image.open(path) as img:
+                return img.convert("RGB")
+        key = SHARED_IMAGE_CACHE.make_key(source_path, ("tile", self.tile_size, level, col, row))
+        return SHARED_IMAGE_CACHE.get_or_load(key, load)
+
+    def render(self, source_path, viewport, loader=None):
+        """
+        Render a view of a source image from its pyramid.
+        Uses the lowest resolution level which still has at least one pixel per canvas pixel.
+        :param viewport: The Viewport to render
+        :param loader: A function without arguments returning the decoded source image, used if
+            the pyramid has to be built (optional)
+        :return: The PIL image of the view, of the canvas size
+        """
+        info = self.ensure(source_path, loader)
+        pixels_per_canvas_pixel = min(viewport.width, viewport.height) / viewport.size
+        level = int(math.floor(math.log2(pixels_per_canvas_pixel))) if pixels_per_canvas_pixel >= 1 else 0
+        level = min(max(level, 0), len(info["levels"]) - 1)
+
+        # The region of the view in the pixels of the level
+        level_width, level_height = info["levels"][level]
+        scale_x, scale_y = level_width / info["width"], level_height / info["height"]
+        x0, y0 = viewport.x * scale_x, viewport.y * scale_y
+        x1, y1 = x0 + viewport.width * scale_x, y0 + viewport.height * scale_y
+
+        # Paste the tiles covering the region into a mosaic
+        tile_size = info["tile_size"]
+        col0, row0 = int(x0 // tile_size), int(y0 // tile_size)
+        col1 = min(int(math.ceil(x1 / tile_size)), int(math.ceil(level_width / tile_size))) - 1
+        row1 = min(int(math.ceil(y1 / tile_size)), int(math.ceil(level_height / tile_size))) - 1
+        mosaic = Image.new("RGB", ((col1 - col0 + 1) * tile_size, (row1 - row0 + 1) * tile_size))
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                mosaic.paste(self.tile(source_path, level, col, row),
+                             ((col - col0) * tile_size, (row - row0) * tile_size))
+
+        box = (x0 - col0 * tile_size, y0 - row0 * tile_size, x1 - col0 * tile_size, y1 - row0 * tile_size)
+        return mosaic.resize((viewport.size, viewport.size), Image.LANCZOS, box=box)
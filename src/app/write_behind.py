@@ -0,0 +1,156 @@
+import json
+import time
+import queue
+import atexit
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
+"""
+Write-behind queue of the annotation saves, shared by all sessions of the process.
+Submitting an image only enqueues its annotations; a background thread writes them to the
+journal in submission order. A failed write is retried with backoff, and if it still fails it is
+appended to a dead-letter file (when given) and kept for its session, so the page can report it
+and retry. The pending writes are flushed when the process exits.
+"""
+
+
+# How long to wait for the pending writes when the process exits
+FLUSH_TIMEOUT_SECONDS = 30
+# Retries of a failed write, waiting RETRY_BACKOFF_SECONDS * 2 ** attempt in between
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+# Failures not picked up by their session within this time are dropped (the session has ended),
+# they remain in the dead-letter file
+FAILURE_TTL_SECONDS = 60 * 60
+
+FailedWrite = namedtuple("FailedWrite", ["description", "write", "error", "dead_letter_path", "record"])
+
+
+class WriteBehindQueue:
+    """
+    Runs the queued writes on a single background thread (in submission order).
+    """
+    def __init__(self, max_retries=MAX_RETRIES, backoff_seconds=RETRY_BACKOFF_SECONDS,
+                 failure_ttl=FAILURE_TTL_SECONDS):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.failure_ttl = failure_ttl
+        self._queue = queue.Queue()
+        # Maps the owners to lists of (time, FailedWrite)
+        self._failures = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._worker = None
+
+    def submit(self, owner, description, write, dead_letter_path=None, record=None):
+        """
+        Queue a write.
+        :param owner: Identifies the session the write belongs to (its failures are reported to it)
+        :param description: Describes the write in the failure reports (e.g. the image file name)
+        :param write: Function without arguments performing the write
+        :param dead_letter_path: The JSONL file the write is appended to if it fails after the retries (optional)
+        :param record: The JSON-serializable data of the write, saved in the dead-letter file
+        :return: A Future of the result of the write
+        """
+        future = Future()
+        with self._condition:
+            self._pending += 1
+            if self._worker is None:
+                # Started on the first write, as a daemon so it never blocks the shutdown (see flush)
+                self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._worker.start()
+        self._queue.put((owner, description, write, dead_letter_path, record, future))
+        return future
+
+    def _run(self):
+        while True:
+            owner, description, write, dead_letter_path, record, future = self._queue.get()
+            try:
+                future.set_result(self._write_with_retries(write))
+            except Exception as e:
+                print(f"Error writing {description}: {e}")
+                future.set_exception(e)
+                failure = FailedWrite(description, write, e, dead_letter_path, record)
+                self._save_dead_letter(owner, failure)
+                with self._condition:
+                    self._prune_failures()
+                    self._failures.setdefault(owner, []).append((time.monotonic(), failure))
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
+
+    def _write_with_retries(self, write):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return write()
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                # The writes are sequential, so the backoff also delays the next writes
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+
+    def _save_dead_letter(self, owner, failure):
+        # Kept on disk, as the session may have ended and never pick the failure up
+        if failure.dead_letter_path is None:
+            return
+        entry = {"time": time.time(), "owner": owner, "description": failure.description,
+                 "error": str(failure.error), "record": failure.record}
+        try:
+            with open(failure.dead_letter_path, "a") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+        except OSError as e:
+            print(f"Error saving {failure.description} to {failure.dead_letter_path}: {e}")
+
+    def _prune_failures(self):
+        # Called with the condition held
+        expired = time.monotonic() - self.failure_ttl
+        for owner in list(self._failures):
+            failures = [(failed_at, failure) for failed_at, failure in self._failures[owner] if failed_at > expired]
+            if failures:
+                self._failures[owner] = failures
+            else:
+                del self._failures[owner]
+
+    def pending_count(self):
+        """
+        Get the number of queued writes which have not finished yet.
+        """
+        with self._condition:
+            return self._pending
+
+    def pop_failures(self, owner):
+        """
+        Get (and forget) the failed writes of a session.
+        :return: A list of FailedWrite tuples
+        """
+        with self._condition:
+            self._prune_failures()
+            return [failure for _, failure in self._failures.pop(owner, [])]
+
+    def retry(self, owner, failures):
+        """
+        Queue the failed writes of a session again.
+        """
+        return [self.submit(owner, failure.description, failure.write, failure.dead_letter_path, failure.record)
+                for failure in failures]
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the queued writes are finished.
+        :param timeout: The maximum number of seconds to wait (None waits indefinitely)
+        :return: True if all the writes are finished
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+
+# Queue of all the sessions of this process
+WRITE_BEHIND_QUEUE = WriteBehindQueue()
+
+
+@atexit.register
+def _flush_on_exit():
+    if not WRITE_BEHIND_QUEUE.flush(timeout=FLUSH_TIMEOUT_SECONDS):
+        print(f"{WRITE_BEHIND_QUEUE.pending_count()} annotation writes were not finished before the exit")
@@ -4,7 +4,8 @@ import pytorch_lightning as pl
 from torch.optim import Adam
 from sklearn.metrics import f1_score
 import torch.nn.functional as F
-from torchvision import transforms
+import numpy as np
+from PIL import Image
 
 
 LABELS = [
@@ -32,13 +33,16 @@ def log_perfromance(outputs, labels, type='train', class_weights=None):
 
 class Classification(pl.LightningModule):
 
-    def __init__(self, num_classes, class_weights=None):
+    def __init__(self, num_classes, class_weights=None, pretrained=True):
         """
         param num_classes: Number of classes in the dataset
+        param pretrained: Initialize with the ImageNet weights (downloads them if needed).
+            Not needed when the fine-tuned weights are loaded afterwards.
         """
         super(Classification, self).__init__()
 
-        self.model = efficientnet_v2_m(weights=EfficientNet_V2_M_Weights.IMAGENET1K_V1)
+        weights = EfficientNet_V2_M_Weights.IMAGENET1K_V1 if pretrained else None
+        self.model = efficientnet_v2_m(weights=weights)
         # Modify the classifier to match the number of classes
         self.model.classifier[1] = torch.nn.Linear(self.model.classifier[1].in_features, num_classes)
         
@@ -90,54 +94,100 @@ class Classification(pl.LightningModule):
         return performance_dict['test_loss']
     
     
+def load_state_dict(model_path):
+    """
+    Load the fine-tuned weights, memory-mapped so that they are not copied into memory up front.
+    Supports torch checkpoints and .safetensors files (requires the safetensors package).
+    """
+    if model_path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(model_path, device="cpu")
+    try:
+        return torch.load(model_path, map_location=torch.device("cpu"), mmap=True, weights_only=True)
+    except RuntimeError:
+        # Checkpoints saved with the legacy (non-zip) serialization cannot be memory-mapped
+        return torch.load(model_path, map_location=torch.device("cpu"), weights_only=True)
+
+
 def load_model(model_path):
     """
     Load the model from the specified path
+    The architecture is built without the ImageNet weights and without initializing the parameters
+    (on the meta device), the fine-tuned weights are then assigned directly, so no network access is needed.
     :param model_name: Name of the model file
-    :return: The loaded model
+    :return: The loaded model (in eval mode)
     """
     
-    classification_model = Classification(num_classes=5)
-    state_dict = torch.load(model_path, map_location=torch.device("cpu"))
-    classification_model.load_state_dict(state_dict)
+    with torch.device("meta"):
+        classification_model = Classification(num_classes=len(LABELS), pretrained=False)
+    state_dict = load_state_dict(model_path)
+    classification_model.load_state_dict(state_dict, assign=True)
             
-    return classification_model
+    return classification_model.eval()
 
 
-def prepare_images(images):
-    MEAN = [0.5, 0.5, 0.5]
-    STD = [0.5, 0.5, 0.5]
+IMAGE_SIZE = 224
+MEAN = 0.5
+STD = 0.5
 
-    image_transforms = transforms.Compose([
-        transforms.ToTensor(),         # Convert image to PyTorch tensor
-        transforms.Normalize(mean=MEAN, std=STD),  # Normalize the tensor
-        transforms.Resize((224, 224))  # Resize the image to 224x224 pixels
-    ])
-    
-    return [image_transforms(image) for image in images]
-    
 
-def inference(model, images):
+def prepare_images(images, out=None):
     """
-    Perform inference on the images using the model
-    :param model: The model to perform inference with
-    :param images: List of PIL images to perform inference on
+    Prepare a batch of images for the model
+    The images are resized to 224x224 while still uint8 (PIL, bilinear), and only the small batch
+    is converted to float and normalized, in a single tensor operation.
+    :param images: List of PIL images (or RGB numpy arrays)
+    :param out: Preallocated float tensor of shape (N, 3, 224, 224) to write the batch into (optional)
+    :return: Tensor of shape (N, 3, 224, 224)
     """
-    # Preprocess the images
-    images = prepare_images(images)
-
-    # Convert the images to a tensor
-    images = torch.stack(images)
+    images = list(images)
+    batch = np.empty((len(images), IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        batch[i] = np.asarray(image.resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR))
+
+    if out is None:
+        out = torch.empty((len(images), 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
+    # (x / 255 - MEAN) / STD, converting the NHWC uint8 batch to the NCHW float layout in the same op
+    torch.div(torch.from_numpy(batch).permute(0, 3, 1, 2), 255 * STD, out=out)
+    return out.sub_(MEAN / STD)
+    
 
-    # Perform inference
-    outputs = model(images)  # Raw logits
-    probabilities = F.softmax(outputs, dim=1)  # Convert to probabilities
+def predict(model, images):
+    """
+    Run the model on a batch of preprocessed images
+    :param model: The model to perform inference with (in eval mode)
+    :param images: Tensor of shape (N, 3, 224, 224)
+    :return: List of (predicted class, confidence) tuples
+    """
+    # Perform inference without tracking gradients
+    with torch.inference_mode():
+        outputs = model(images)  # Raw logits
+        probabilities = F.softmax(outputs, dim=1)  # Convert to probabilities
 
-   # Get the predicted class and confidence scores
+    # Get the predicted class and confidence scores
     confidences, preds = torch.max(probabilities, 1)
     # Round the confidence scores
-    confidences = [round(conf.item(), 3) for conf in confidences]
+    confidences = [round(conf, 3) for conf in confidences.tolist()]
 
     preds_classes = [LABELS[pred] for pred in preds.tolist()]  # Convert to class   
 
-    return list(zip(preds_classes, confidences))
\ No newline at end of file
+    return list(zip(preds_classes, confidences))
+
+
+def inference(model, images):
+    """
+    Perform inference on the images using the model
+    :param model: The model to perform inference with (any backend of model_export.load_backend)
+    :param images: List of PIL images to perform inference on
+    """
+    # Disable dropout and use the running batch norm statistics
+    model.eval()
+
+    # Preprocess the images into a batch tensor
+    images = prepare_images(images)
+
+    return predict(model, images)
@@ -1,9 +1,16 @@
+import os
+import time
 import pytesseract
 import matplotlib.pyplot as plt
 import numpy as np
 import cv2
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 from pytesseract import Output
 
+from ocr_cache import OcrCache
+
 """
 This module contains method for preprocessing X ray images before feeding them to the model.
 The preprocessing steps include removing the black regions from the image as well as removing any text present in the image.
@@ -14,15 +21,125 @@ The preprocessing steps include removing the black regions from the image as wel
 pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
 
 
-def get_text_bounding_boxes(image):
+@lru_cache(maxsize=None)
+def tesseract_version():
+    return str(pytesseract.get_tesseract_version())
+
+
+@lru_cache(maxsize=None)
+def _ocr_cache_at(path):
+    # One OcrCache per folder and process, so its size is not recomputed for every image
+    return OcrCache(path)
+
+
+def get_text_bounding_boxes(image, config="", cache=None):
     """
     Get the bounding boxes around text regions in the image using pytesseract.
     :param image: The image to process.
+    :param config: Additional Tesseract arguments.
+    :param cache: An OcrCache (or the path of its folder) to reuse the results of previous runs (optional).
     """
     # Conver the image to a numpy array
     if not isinstance(image, np.ndarray):
         image = np.array(image)
-    return pytesseract.image_to_data(image, output_type=Output.DICT)
+
+    if cache is None:
+        return pytesseract.image_to_data(image, config=config, output_type=Output.DICT)
+
+    if not isinstance(cache, OcrCache):
+        cache = _ocr_cache_at(cache)
+    key = cache.make_key(image, f"{tesseract_version()}:{config}")
+    boxes = cache.get(key)
+    if boxes is None:
+        boxes = pytesseract.image_to_data(image, config=config, output_type=Output.DICT)
+        cache.put(key, boxes)
+    return boxes
+
+
+def text_regions(shape, border=None):
+    """
+    Get the regions of the image to run the OCR on.
+    :param shape: The shape of the image.
+    :param border: The fraction of the height/width covered by the top, bottom, left and right
+        border bands (e.g. 0.15), or None for the whole image.
+    :return: A list of (x0, y0, x1, y1) regions.
+    """
+    h, w = shape[:2]
+    if border is None:
+        return [(0, 0, w, h)]
+    band_h = max(int(round(h * border)), 1)
+    band_w = max(int(round(w * border)), 1)
+    return [
+        (0, 0, w, band_h),                              # top
+        (0, h - band_h, w, h),                          # bottom
+        (0, band_h, band_w, h - band_h),                # left
+        (w - band_w, band_h, w, h - band_h),            # right
+    ]
+
+
+def detect_text_boxes(image, scale=1.0, border=None, config="", cache=None):
+    """
+    Detect the text boxes on a downscaled copy of the image and/or only in its border bands,
+    where the burned-in text of radiographs almost always is. The boxes are mapped back to
+    the full-resolution coordinates, in the format of get_text_bounding_boxes.
+    :param image: The image to process.
+    :param scale: The downscaling factor applied before the OCR (e.g. 0.5).
+    :param border: The fraction of the image covered by the border bands (see text_regions), or None.
+    :param config: Additional Tesseract arguments.
+    :param cache: An OcrCache (or the path of its folder) (optional).
+    """
+    if not isinstance(image, np.ndarray):
+        image = np.array(image)
+    if scale == 1.0 and border is None:
+        return get_text_bounding_boxes(image, config=config, cache=cache)
+
+    merged = {key: [] for key in ('level', 'left', 'top', 'width', 'height', 'conf', 'text')}
+    # Margin (in full-resolution pixels) compensating the rounding of the downscaled coordinates
+    margin = int(np.ceil(1.0 / scale))
+    for x0, y0, x1, y1 in text_regions(image.shape, border):
+        region = image[y0:y1, x0:x1]
+        if scale != 1.0:
+            size = (max(int(round((x1 - x0) * scale)), 1), max(int(round((y1 - y0) * scale)), 1))
+            region = cv2.resize(region, size, interpolation=cv2.INTER_AREA)
+        boxes = get_text_bounding_boxes(region, config=config, cache=cache)
+
+        for i in range(len(boxes['level'])):
+            left = x0 + int(boxes['left'][i] / scale) - margin
+            top = y0 + int(boxes['top'][i] / scale) - margin
+            merged['left'].append(max(left, 0))
+            merged['top'].append(max(top, 0))
+            merged['width'].append(int(np.ceil(boxes['width'][i] / scale)) + 2 * margin + min(left, 0))
+            merged['height'].append(int(np.ceil(boxes['height'][i] / scale)) + 2 * margin + min(top, 0))
+            for key in ('level', 'conf', 'text'):
+                merged[key].append(boxes[key][i])
+    return merged
+
+
+def text_mask(shape, boxes, confidence_threshold=50):
+    """
+    Build a boolean mask of the text regions that remove_text would black out.
+    """
+    keep = np.ones(shape[:2], dtype=bool)
+    remove_text(keep, boxes, confidence_threshold=confidence_threshold, inplace=True)
+    return ~keep
+
+
+def ocr_recall(image, scale=0.5, border=0.15, confidence_threshold=50, config="", cache=None):
+    """
+    Compare the fast OCR mode with the full-image OCR: the recall is the fraction of the text pixels
+    removed with the full-image OCR which are also removed with the fast mode.
+    :return: A dict with the recall and the number of text pixels of both modes.
+    """
+    full = text_mask(image.shape, get_text_bounding_boxes(image, config=config, cache=cache), confidence_threshold)
+    fast = text_mask(
+        image.shape, detect_text_boxes(image, scale=scale, border=border, config=config, cache=cache),
+        confidence_threshold)
+    full_pixels = int(full.sum())
+    return {
+        "recall": float((full & fast).sum() / full_pixels) if full_pixels else 1.0,
+        "full_pixels": full_pixels,
+        "fast_pixels": int(fast.sum()),
+    }
 
 
 def plot_text_bounding_boxes(image, boxes, ax):
@@ -59,30 +176,51 @@ def plot_text_bounding_boxes(image, boxes, ax):
     ax.axis('off')
 
 
-def remove_text(image, boxes, confidence_threshold=50):
+def remove_text(image, boxes, confidence_threshold=50, inplace=False):
     """
     Remove text regions from the image by overlaying black rectangles on the text regions.
     :param image: The image to process.
     :param boxes: The bounding boxes and text extracted from the image.
     :param confidence_threshold: The confidence threshold to determine if a text region should be removed.
+    :param inplace: Black out the text regions directly in the given image instead of a copy.
     """
-
-    # Create a mask to black out the text regions
-    mask = np.ones_like(image) * 255
-    n_boxes = len(boxes['level'])
-    for i in range(n_boxes):
-        text = boxes['text'][i]
-        conf = boxes['conf'][i]
-        (x, y, w, h) = (
-            boxes['left'][i], boxes['top'][i], 
-            boxes['width'][i], boxes['height'][i]
-        )
-        if text.strip() and int(conf) > confidence_threshold:
-            # Black out the text region
-            mask[y:y+h, x:x+w] = 0
-    
-    # Apply the mask to the image
-    return cv2.bitwise_and(image, mask)
+    # Select the boxes with non-empty text and a confidence above the threshold
+    # (the confidences are truncated to integers, as Tesseract reports them as strings or floats)
+    confidences = np.asarray(boxes['conf'], dtype=np.float64).astype(np.int64)
+    has_text = np.fromiter((bool(text.strip()) for text in boxes['text']), dtype=bool, count=len(confidences))
+    selected = np.flatnonzero(has_text & (confidences > confidence_threshold))
+
+    output = image if inplace else image.copy()
+    if selected.size == 0:
+        return output
+
+    left = np.asarray(boxes['left'])[selected]
+    top = np.asarray(boxes['top'])[selected]
+    right = left + np.asarray(boxes['width'])[selected]
+    bottom = top + np.asarray(boxes['height'])[selected]
+    # Black out the text regions (a handful of slice assignments, no full-size mask)
+    for x0, y0, x1, y1 in zip(left.tolist(), top.tolist(), right.tolist(), bottom.tolist()):
+        output[y0:y1, x0:x1] = 0
+    return output
+
+
+def row_median_at_least(gray, threshold):
+    """
+    Check for every row whether its median is at least the threshold, without sorting the rows.
+    A row's median is at least the threshold if more than half of its pixels are; only the rows
+    where exactly half of the pixels are (possible for an even width) need the actual median.
+    :param gray: The 2D image.
+    :param threshold: The threshold value.
+    :return: A boolean array with one value per row.
+    """
+    n = gray.shape[1]
+    counts = np.count_nonzero(gray >= threshold, axis=1)
+    valid = counts > n // 2
+    if n % 2 == 0:
+        ambiguous = np.flatnonzero(counts == n // 2)
+        if ambiguous.size:
+            valid[ambiguous] = np.median(gray[ambiguous], axis=1) >= threshold
+    return valid
 
 
 def thresholding_crop(image, type='median', threshold=1):
@@ -90,56 +228,35 @@ def thresholding_crop(image, type='median', threshold=1):
     Crop the top and bottom parts of the image based on a pixel intensity threshold.
     Processes from both top and bottom, stopping once a valid row is found in each direction.
 
-    :param image: The image to process (expected in BGR format).
+    :param image: The image to process (expected in BGR format or grayscale).
     :param type: The method to calculate row intensity ('median' or 'mean').
     :param threshold: The threshold value to determine if a row is part of the foreground.
-    :return: Cropped image with background rows removed from top and bottom.
+    :return: Cropped image with background rows removed from top and bottom (a view of the image, not a copy).
     """
     # Convert the image to grayscale
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-    # Calculate the row intensity values based on the specified type
+    # Create a boolean array where True indicates the row meets or exceeds the threshold
     if type == 'median':
-        row_val = np.median(gray, axis=1)
+        valid_rows = row_median_at_least(gray, threshold)
     else:
-        row_val = np.mean(gray, axis=1)
-
-    # Create a boolean array where True indicates the row meets or exceeds the threshold
-    valid_rows = row_val >= threshold
-
-    # Initialize top and bottom indices
-    top = None
-    bottom = None
-
-    # Find the first valid row from the top
-    for i in range(len(valid_rows)):
-        if valid_rows[i]:
-            top = i
-            break
-
-    # Find the first valid row from the bottom
-    for i in range(len(valid_rows)-1, -1, -1):
-        if valid_rows[i]:
-            bottom = i
-            break
+        # mean >= threshold <=> sum >= threshold * width, which avoids the floating point division
+        dtype = np.int64 if np.issubdtype(gray.dtype, np.integer) else np.float64
+        valid_rows = gray.sum(axis=1, dtype=dtype) >= threshold * gray.shape[1]
 
     # If no valid rows are found, return the original image
-    if top is None or bottom is None:
-        # No valid rows found based on the threshold. Returning the original image.
+    if not valid_rows.any():
         return image
 
-    # Ensure that top is above bottom
-    if top > bottom:
-        # Top index is below bottom index. Returning the original image
-        return image
+    # Find the first valid row from the top and from the bottom
+    top = int(np.argmax(valid_rows))
+    bottom = len(valid_rows) - 1 - int(np.argmax(valid_rows[::-1]))
 
     # Crop the image between the top and bottom indices (inclusive)
-    cropped_image = image[top:bottom + 1, :]
+    return image[top:bottom + 1, :]
 
-    return cropped_image
 
-
-def improve_contrast(image, alpha=1.0, beta=0):
+def improve_contrast(image, alpha=1.0, beta=0, inplace=False):
     """
     Apply a contrast adjustment to the image using the formula:
     g(x) = alpha * f(x) + beta
@@ -147,8 +264,11 @@ def improve_contrast(image, alpha=1.0, beta=0):
     :param image: The image to adjust the contrast of.
     :param alpha: The contrast adjustment factor.
     :param beta: The brightness adjustment factor.
+    :param inplace: Write the result into the given image (must be uint8).
     :return: The image with adjusted contrast.
     """
+    if inplace and image.dtype == np.uint8:
+        return cv2.convertScaleAbs(image, dst=image, alpha=alpha, beta=beta)
     adjusted = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
     return adjusted
 
@@ -194,30 +314,137 @@ def padded_resize(image, target_size=(224, 224), pad_value=0):
 
 
 
+@contextmanager
+def _stage(timings, name):
+    """
+    Measure the duration (in seconds) of a preprocessing stage if a timings dict is given.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def load_image(path):
+    """
+    Read an image from disk as an RGB numpy array.
+    """
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Could not read the image {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
 # FINAL METHOD TO BE USED IN THE PIPELINE
-def preprocess_image(image, text_confidence_threshold=50, crop_threshold=40, target_size=(224, 224)):
+def preprocess_image(image, text_confidence_threshold=50, crop_threshold=40, target_size=(224, 224), timings=None,
+                     ocr_cache=None, inplace=False, ocr_scale=1.0, ocr_border=None):
     """
     Preprocess the image by removing text regions and background rows.
     :param image: The image to preprocess.
     :param text_confidence_threshold: The confidence threshold to determine if a text region should be removed.
     :param crop_threshold: The threshold value to determine if a row is part of the foreground.
+    :param timings: A dict to which the duration of every stage is added (optional).
+    :param ocr_cache: An OcrCache (or the path of its folder), so that parameter sweeps only run the OCR once (optional).
+    :param inplace: Modify the given image instead of a copy, which saves two full-size copies.
+    :param ocr_scale: Run the OCR on a copy downscaled by this factor (see detect_text_boxes).
+    :param ocr_border: Only run the OCR on border bands covering this fraction of the image (see detect_text_boxes).
     :return: The preprocessed image.
     """
 
     # Extract text bounding boxes for the text regions in the image
-    bounding_boxes = get_text_bounding_boxes(image)
+    with _stage(timings, "ocr"):
+        bounding_boxes = detect_text_boxes(image, scale=ocr_scale, border=ocr_border, cache=ocr_cache)
     # Overlay black rectangles on the text regions with a confidence score greater than the threshold
-    image_no_text = remove_text(image, bounding_boxes, confidence_threshold=text_confidence_threshold)
-    image_no_text = improve_contrast(image_no_text, alpha=0.7, beta=0.)
+    with _stage(timings, "remove_text"):
+        image_no_text = remove_text(
+            image, bounding_boxes, confidence_threshold=text_confidence_threshold, inplace=inplace)
+    with _stage(timings, "contrast"):
+        # The text-free image is already a private copy unless inplace was requested
+        image_no_text = improve_contrast(image_no_text, alpha=0.7, beta=0., inplace=True)
     # Crop the image to remove the background row by row
-    cropped_image = thresholding_crop(image_no_text, type='average', threshold=crop_threshold)
+    with _stage(timings, "crop"):
+        cropped_image = thresholding_crop(image_no_text, type='average', threshold=crop_threshold)
     
     if target_size is not None:
         # Resize the image to the target size
-        cropped_image = padded_resize(cropped_image, target_size=target_size)
+        with _stage(timings, "resize"):
+            cropped_image = padded_resize(cropped_image, target_size=target_size)
     return cropped_image
 
 
+def _init_worker():
+    # Tesseract (a subprocess inheriting this environment) uses all the cores with OpenMP by default,
+    # which oversubscribes the cores when one Tesseract runs per worker process
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _preprocess_job(index, image, kwargs):
+    # Runs in a worker process: paths are read there, so only the path is sent to the worker
+    timings = {}
+    try:
+        if isinstance(image, (str, os.PathLike)):
+            with _stage(timings, "load"):
+                image = load_image(image)
+        # The image was read or unpickled in this process, so it can be modified in place
+        kwargs = dict(kwargs, inplace=True)
+        result = preprocess_image(image, timings=timings, **kwargs)
+    except Exception as e:
+        # Reported per image, so one unreadable file does not stop the whole batch
+        return index, None, {"error": f"{type(e).__name__}: {e}"}
+    return index, result, timings
+
+
+def preprocess_images(images, max_workers=None, max_in_flight=None, ordered=True, **kwargs):
+    """
+    Preprocess a batch of images in parallel over a process pool.
+    At most max_in_flight images are submitted or waiting to be yielded at any time, so
+    arbitrarily long (lazy) iterables can be processed with bounded memory.
+    :param images: An iterable of image paths or numpy arrays (RGB).
+    :param max_workers: The number of worker processes (defaults to the number of CPU cores).
+    :param max_in_flight: The maximum number of images in progress (defaults to twice the number of workers).
+    :param ordered: Yield the results in the input order, otherwise as soon as they are ready.
+    :param kwargs: The arguments passed to preprocess_image.
+    :return: A generator of (index, preprocessed image, timings) tuples, where timings maps the stage
+        names ("load", "ocr", "remove_text", "contrast", "crop", "resize") to their duration in seconds.
+        An image which failed (e.g. an unreadable file) is yielded as (index, None, {"error": message}).
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or 2 * max_workers, 1)
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        in_flight = set()
+        # Finished results waiting to be yielded in order
+        finished = {}
+        next_index = 0
+
+        def collect(return_when):
+            nonlocal in_flight, next_index
+            done, in_flight = wait(in_flight, return_when=return_when)
+            results = []
+            for future in done:
+                index, result, timings = future.result()
+                if not ordered:
+                    results.append((index, result, timings))
+                else:
+                    finished[index] = (index, result, timings)
+            while next_index in finished:
+                results.append(finished.pop(next_index))
+                next_index += 1
+            return results
+
+        for index, image in enumerate(images):
+            while len(in_flight) + len(finished) >= max_in_flight:
+                yield from collect(FIRST_COMPLETED)
+            in_flight.add(executor.submit(_preprocess_job, index, image, kwargs))
+
+        while in_flight:
+            yield from collect(FIRST_COMPLETED)
+
+
 if __name__ == '__main__':
     img_path = "C:/Users/mjgoj/Desktop/DeepGruble/insurance_X_rays_images_Felix/images/v3.jpg"
     image = cv2.imread(img_path)
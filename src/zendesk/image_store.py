@@ -0,0 +1,86 @@
+import os
+import hashlib
+import zipfile
+import tempfile
+
+from atomic_files import atomic_write
+
+"""
+Content-addressed store of the dental images retrieved from Zendesk.
+Images are named after the SHA-256 of their content, so an X-ray sent more than once is stored once.
+"""
+
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".jfif", ".bmp", ".tif", ".tiff", ".gif", ".webp"}
+
+# Members up to this size are hashed in memory, so duplicates are never written to disk
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+def is_image_member(member):
+    """
+    Check if a zip archive member is an image (skips folders, hidden files and macOS metadata).
+    """
+    name = member.filename
+    base_name = os.path.basename(name)
+    if member.is_dir() or not base_name or base_name.startswith(".") or name.startswith("__MACOSX/"):
+        return False
+    return os.path.splitext(base_name)[1].lower() in IMAGE_EXTENSIONS
+
+
+class ImageStore:
+    """
+    Stores images under <root>/<first 2 hex digits>/<sha256><extension>.
+    """
+    def __init__(self, root, chunk_size=1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path_for(self, digest, extension):
+        return os.path.join(self.root, digest[:2], f"{digest}{extension.lower()}")
+
+    def add_stream(self, stream, extension):
+        """
+        Add an image from a binary stream.
+        :param stream: A readable binary file object
+        :param extension: The file extension of the image (e.g. ".jpg")
+        :return: A (digest, path, is_new) tuple
+        """
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            for chunk in iter(lambda: stream.read(self.chunk_size), b""):
+                digest.update(chunk)
+                spool.write(chunk)
+            digest = digest.hexdigest()
+
+            path = self.path_for(digest, extension)
+            if os.path.exists(path):
+                return digest, path, False
+
+            folder = os.path.dirname(path)
+            if not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            # A crash never leaves a partial image in the store
+            spool.seek(0)
+            with atomic_write(path, "wb") as f:
+                for chunk in iter(lambda: spool.read(self.chunk_size), b""):
+                    f.write(chunk)
+            return digest, path, True
+
+    def add_zip_images(self, zip_file):
+        """
+        Add the image members of a zip archive to the store, without extracting the archive.
+        :param zip_file: A path or seekable binary file object of the zip archive
+        :return: A list of (member_name, digest, path, is_new) tuples
+        """
+        images = []
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            for member in zip_ref.infolist():
+                if not is_image_member(member):
+                    continue
+                with zip_ref.open(member) as stream:
+                    digest, path, is_new = self.add_stream(stream, os.path.splitext(member.filename)[1])
+                images.append((member.filename, digest, path, is_new))
+        return images
@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from classification_model_inference import prepare_images, predict, IMAGE_SIZE
+from model_export import load_backend
+
+"""
+Long-lived inference engine for the image-type classifier.
+The model is loaded once, and the images submitted from any thread are grouped into
+micro-batches, so the CPU runs full batches instead of one forward pass per caller.
+"""
+
+
+class InferenceEngine:
+    """
+    Runs the classification model on micro-batches in a background thread.
+
+    A batch is run as soon as batch_size images are queued, or max_wait seconds after
+    the first image of the batch was queued, whichever comes first.
+    """
+    def __init__(self, model_path=None, model=None, batch_size=32, max_wait=0.05, num_threads=None,
+                 backend="fp32"):
+        """
+        :param model_path: Path of the fine-tuned weights or exported model (used if no model is given)
+        :param model: An already loaded model (optional)
+        :param batch_size: The maximum number of images per forward pass
+        :param max_wait: The maximum time (seconds) to wait for a batch to fill up
+        :param num_threads: The number of CPU threads used by torch (optional)
+        :param backend: The backend used to load model_path ("fp32", "int8", "torchscript" or "onnx")
+        """
+        if model is None:
+            model = load_backend(model_path, backend, num_threads=num_threads)
+        elif num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        # Reused by every batch, so the batches do not allocate new input tensors
+        self._buffer = torch.empty((batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="inference-engine", daemon=True)
+        self._worker.start()
+
+    def submit(self, image_id, image):
+        """
+        Queue an image for classification.
+        :param image_id: The id of the image, returned with the result
+        :param image: The PIL image
+        :return: A Future resolving to (image_id, predicted class, confidence)
+        """
+        if self._closed:
+            raise RuntimeError("The inference engine is closed")
+        future = Future()
+        self._queue.put((image_id, image, future))
+        return future
+
+    def classify(self, images):
+        """
+        Classify a collection of images.
+        :param images: A dict mapping image ids to PIL images, or an iterable of (image_id, image) pairs
+        :return: A dict mapping the image ids to (predicted class, confidence) tuples
+        """
+        if isinstance(images, dict):
+            images = images.items()
+        futures = [self.submit(image_id, image) for image_id, image in images]
+        results = {}
+        for future in futures:
+            image_id, pred_class, confidence = future.result()
+            results[image_id] = (pred_class, confidence)
+        return results
+
+    def close(self):
+        """
+        Stop the engine after the queued images are processed.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None, True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                continue
+            image_ids, images, futures = zip(*batch)
+            try:
+                results = predict(self.model, prepare_images(images, out=self._buffer[:len(images)]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for image_id, (pred_class, confidence), future in zip(image_ids, results, futures):
+                future.set_result((image_id, pred_class, confidence))
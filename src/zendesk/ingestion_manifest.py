@@ -0,0 +1,168 @@
+import time
+import sqlite3
+import hashlib
+import threading
+
+"""
+Persistent manifest of the Zendesk ingestion, used to resume an interrupted ingestion.
+It records the state of every ticket and attachment as well as the position reached in the view.
+"""
+
+
+# Ticket states
+TICKET_PENDING = "pending"
+TICKET_COMPLETE = "complete"
+TICKET_FAILED = "failed"
+
+# Attachment states
+ATTACHMENT_PENDING = "pending"
+ATTACHMENT_DOWNLOADED = "downloaded"
+ATTACHMENT_EXTRACTED = "extracted"
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 checksum of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IngestionManifest:
+    """
+    SQLite-backed ingestion manifest. Safe to use from the concurrent download workers.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS tickets (
+                    ticket_id INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    updated_at REAL NOT NULL
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS attachments (
+                    attachment_id INTEGER PRIMARY KEY,
+                    ticket_id INTEGER NOT NULL,
+                    file_name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    size INTEGER,
+                    checksum TEXT,
+                    updated_at REAL NOT NULL
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS ticket_images (
+                    ticket_id INTEGER NOT NULL,
+                    attachment_id INTEGER NOT NULL,
+                    member_name TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (attachment_id, member_name)
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS view_cursors (
+                    view_id TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    last_ticket_id INTEGER,
+                    updated_at REAL NOT NULL
+                )""")
+
+    def _execute(self, query, params=()):
+        with self._lock, self.connection:
+            return self.connection.execute(query, params).fetchall()
+
+    def ticket_state(self, ticket_id):
+        """
+        Get the state of a ticket (None if the ticket was never seen).
+        """
+        rows = self._execute("SELECT state FROM tickets WHERE ticket_id = ?", (ticket_id,))
+        return rows[0][0] if rows else None
+
+    def set_ticket_state(self, ticket_id, state, error=None):
+        self._execute("""
+            INSERT INTO tickets (ticket_id, state, error, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (ticket_id) DO UPDATE SET
+                state = excluded.state, error = excluded.error, updated_at = excluded.updated_at""",
+            (ticket_id, state, error, time.time()))
+
+    def attachment(self, attachment_id):
+        """
+        Get the manifest entry of an attachment as a dict (None if the attachment was never seen).
+        """
+        rows = self._execute(
+            "SELECT ticket_id, file_name, state, size, checksum FROM attachments WHERE attachment_id = ?",
+            (attachment_id,))
+        if not rows:
+            return None
+        ticket_id, file_name, state, size, checksum = rows[0]
+        return {"attachment_id": attachment_id, "ticket_id": ticket_id, "file_name": file_name,
+                "state": state, "size": size, "checksum": checksum}
+
+    def set_attachment_state(self, attachment_id, ticket_id, file_name, state, size=None, checksum=None):
+        """
+        Record the state of an attachment. The size and checksum are kept if not given.
+        """
+        self._execute("""
+            INSERT INTO attachments (attachment_id, ticket_id, file_name, state, size, checksum, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (attachment_id) DO UPDATE SET
+                state = excluded.state,
+                size = COALESCE(excluded.size, attachments.size),
+                checksum = COALESCE(excluded.checksum, attachments.checksum),
+                updated_at = excluded.updated_at""",
+            (attachment_id, ticket_id, file_name, state, size, checksum, time.time()))
+
+    def add_ticket_images(self, ticket_id, attachment_id, images):
+        """
+        Record the images of an attachment stored in the content-addressed image store.
+        :param images: A list of (member_name, digest, path) tuples
+        """
+        with self._lock, self.connection:
+            self.connection.executemany("""
+                INSERT OR REPLACE INTO ticket_images (ticket_id, attachment_id, member_name, digest, path)
+                VALUES (?, ?, ?, ?, ?)""",
+                [(ticket_id, attachment_id, member_name, digest, path) for member_name, digest, path in images])
+
+    def ticket_images(self, ticket_id):
+        """
+        Get the (member_name, digest, path) tuples of the stored images of a ticket.
+        """
+        return self._execute(
+            "SELECT member_name, digest, path FROM ticket_images WHERE ticket_id = ? ORDER BY attachment_id, member_name",
+            (ticket_id,))
+
+    def cursor(self, view_id):
+        """
+        Get the number of tickets of the view which were already processed in listing order.
+        """
+        rows = self._execute("SELECT position FROM view_cursors WHERE view_id = ?", (str(view_id),))
+        return rows[0][0] if rows else 0
+
+    def set_cursor(self, view_id, position, last_ticket_id=None):
+        self._execute("""
+            INSERT INTO view_cursors (view_id, position, last_ticket_id, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (view_id) DO UPDATE SET
+                position = excluded.position, last_ticket_id = excluded.last_ticket_id,
+                updated_at = excluded.updated_at""",
+            (str(view_id), position, last_ticket_id, time.time()))
+
+    def summary(self):
+        """
+        Count the tickets and attachments per state.
+        """
+        return {
+            "tickets": dict(self._execute("SELECT state, COUNT(*) FROM tickets GROUP BY state")),
+            "attachments": dict(self._execute("SELECT state, COUNT(*) FROM attachments GROUP BY state")),
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
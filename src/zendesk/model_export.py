@@ -0,0 +1,161 @@
+import os
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from classification_model_inference import load_model, prepare_images, predict
+
+"""
+Export and serving variants of the image-type classifier for CPU-only nodes:
+dynamic int8 quantization, TorchScript and ONNX (optionally int8-quantized with ONNX Runtime),
+plus a parity check of the variants against the fp32 model.
+"""
+
+
+BACKENDS = ("fp32", "int8", "torchscript", "onnx")
+INPUT_SHAPE = (1, 3, 224, 224)
+
+
+class OnnxModel:
+    """
+    Wraps an ONNX Runtime session so it can be used like the torch model (see predict/inference).
+    """
+    def __init__(self, onnx_path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        outputs = self.session.run(None, {self.input_name: images.numpy().astype(np.float32, copy=False)})
+        return torch.from_numpy(outputs[0])
+
+    def eval(self):
+        return self
+
+
+def quantize_model(model):
+    """
+    Apply dynamic int8 quantization to the linear layers of the model.
+    Only the classifier head of EfficientNet is linear, so the speed-up of this variant is modest;
+    the quantized ONNX variant also quantizes the convolutions.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_torchscript(model, output_path):
+    """
+    Trace the model and save a frozen TorchScript module.
+    """
+    with torch.inference_mode():
+        traced = torch.jit.trace(model.eval(), torch.zeros(INPUT_SHAPE))
+    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    torch.jit.save(traced, output_path)
+    return output_path
+
+
+def export_onnx(model, output_path, opset_version=17):
+    """
+    Export the model to ONNX with a dynamic batch dimension.
+    """
+    torch.onnx.export(
+        model.eval(), torch.zeros(INPUT_SHAPE), output_path,
+        input_names=["images"], output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset_version)
+    return output_path
+
+
+def quantize_onnx(onnx_path, output_path):
+    """
+    Apply dynamic int8 quantization to an ONNX model (weights of the convolutions and linear layers).
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(onnx_path, output_path, weight_type=QuantType.QUInt8)
+    return output_path
+
+
+def load_backend(model_path, backend="fp32", num_threads=None):
+    """
+    Load the classifier with the selected backend
+    :param model_path: The fine-tuned weights ("fp32", "int8"), TorchScript file ("torchscript") or ONNX file ("onnx")
+    :param backend: One of BACKENDS
+    :return: A model usable with inference(), predict() and the InferenceEngine
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    if backend == "fp32":
+        return load_model(model_path)
+    if backend == "int8":
+        return quantize_model(load_model(model_path))
+    if backend == "torchscript":
+        return torch.jit.load(model_path, map_location="cpu").eval()
+    return OnnxModel(model_path, num_threads=num_threads)
+
+
+def parity_check(reference, candidate, image_folder, batch_size=16):
+    """
+    Compare the predictions of a model variant with the fp32 model on a held-out folder of images.
+    :param reference: The fp32 model
+    :param candidate: The model variant
+    :param image_folder: Folder with the held-out images
+    :return: A dict with the number of images, the agreement rate of the predicted classes and
+        the maximum absolute difference of the confidences
+    """
+    extensions = Image.registered_extensions()
+    paths = sorted(
+        os.path.join(image_folder, file_name) for file_name in os.listdir(image_folder)
+        if os.path.splitext(file_name)[1].lower() in extensions)
+
+    agreements = 0
+    max_confidence_diff = 0.0
+    for i in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[i:i + batch_size]:
+            with Image.open(path) as img:
+                images.append(img.convert("RGB"))
+        batch = prepare_images(images)
+        for (ref_class, ref_conf), (cand_class, cand_conf) in zip(predict(reference, batch), predict(candidate, batch)):
+            agreements += ref_class == cand_class
+            max_confidence_diff = max(max_confidence_diff, abs(ref_conf - cand_conf))
+
+    return {
+        "images": len(paths),
+        "agreement": agreements / len(paths) if paths else 1.0,
+        "max_confidence_diff": round(max_confidence_diff, 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the image-type classifier for CPU inference.")
+    parser.add_argument("model_path", help="Path of the fine-tuned weights")
+    parser.add_argument("output_dir", help="Folder to write the exported models to")
+    parser.add_argument("--parity-folder", help="Held-out image folder for the parity check")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    model = load_model(args.model_path)
+    torchscript_path = export_torchscript(model, os.path.join(args.output_dir, "classifier.pt"))
+    onnx_path = export_onnx(model, os.path.join(args.output_dir, "classifier.onnx"))
+    onnx_int8_path = quantize_onnx(onnx_path, os.path.join(args.output_dir, "classifier.int8.onnx"))
+
+    if args.parity_folder:
+        variants = {
+            "int8": quantize_model(load_model(args.model_path)),
+            "torchscript": load_backend(torchscript_path, "torchscript"),
+            "onnx": load_backend(onnx_path, "onnx"),
+            "onnx int8": load_backend(onnx_int8_path, "onnx"),
+        }
+        for name, variant in variants.items():
+            print(name, parity_check(model, variant, args.parity_folder))
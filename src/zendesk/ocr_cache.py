@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from atomic_files import atomic_write
+
+"""
+Persistent cache of the Tesseract OCR results.
+The burned-in text of a radiograph never changes, so the text boxes are keyed by the content
+hash of the image and the Tesseract configuration, and reused across preprocessing runs.
+"""
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def image_hash(image):
+    """
+    Compute the content hash of an image (numpy array or PIL image).
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256(f"{image.shape}:{image.dtype}".encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+class OcrCache:
+    """
+    Stores the OCR results as small JSON files under <root>/<first 2 hex digits>/<key>.json.
+    The least recently used results are evicted once the cache exceeds max_bytes.
+    Safe to share between processes (results are written atomically).
+    """
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        if not os.path.exists(root):
+            os.makedirs(root, exist_ok=True)
+        # Computed on the first write, so opening the cache to read from it stays cheap
+        self.current_bytes = None
+
+    def make_key(self, image, config=""):
+        """
+        Build the cache key of an image for the given Tesseract configuration.
+        :param config: Anything that changes the OCR output (e.g. the Tesseract version and arguments)
+        """
+        return hashlib.sha256(f"{image_hash(image)}:{config}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _entries(self):
+        for folder, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(".json"):
+                    path = os.path.join(folder, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # Evicted by another process
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """
+        Get the cached OCR result or None if it is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                result = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Update the modification time, used as the recency for the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """
+        Cache an OCR result (a dict of lists as returned by pytesseract.image_to_data).
+        """
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump(result, f)
+
+        if self.current_bytes is None:
+            self.current_bytes = sum(size for _, size, _ in self._entries())
+        else:
+            self.current_bytes += os.path.getsize(path)
+        if self.current_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache uses at most 90% of max_bytes.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.current_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.current_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.current_bytes -= size
@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from image_preprocessing import preprocess_images
+from atomic_files import atomic_path
+
+"""
+Materialized cache of the preprocessed 224x224 images, used for training and inference.
+The preprocessed images are stored once as a memory-mapped uint8 array with an index file,
+so an epoch only reads the ready-made tensors instead of decoding the images and running the OCR.
+The cache is invalidated by the hash of the preprocessing parameters.
+"""
+
+
+IMAGE_SIZE = 224
+# Bump when the preprocessing code changes in a way that changes its output
+PIPELINE_VERSION = 1
+
+# Arguments of preprocess_image which do not change its output (helper objects and options)
+NON_OUTPUT_PARAMETERS = ("ocr_cache", "timings", "inplace")
+
+# Same normalization as prepare_images
+MEAN = 0.5
+STD = 0.5
+
+
+def output_parameters(preprocess_kwargs):
+    """
+    Select the preprocessing parameters which change the preprocessed images.
+    """
+    return {name: value for name, value in preprocess_kwargs.items() if name not in NON_OUTPUT_PARAMETERS}
+
+
+def parameters_hash(preprocess_kwargs):
+    """
+    Hash the preprocessing parameters (and the pipeline version) to name the cache.
+    Only the parameters which change the preprocessed images are hashed, so that e.g. passing
+    an OcrCache object still reuses the cache.
+    """
+    parameters = {"version": PIPELINE_VERSION, "size": IMAGE_SIZE, **output_parameters(preprocess_kwargs)}
+    # default=str only for value types such as numpy scalars, whose str() is stable
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _source_signature(paths):
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns] for path in paths]
+
+
+def build_tensor_cache(paths, cache_dir, labels=None, preprocess_kwargs=None, max_workers=None):
+    """
+    Preprocess the images once and store them in a memory-mapped array.
+    An existing cache built from the same images and parameters is reused.
+    :param paths: The image paths.
+    :param cache_dir: The root folder of the caches.
+    :param labels: The class index of every image (optional).
+    :param preprocess_kwargs: The arguments passed to preprocess_image (target_size is always 224x224).
+    :param max_workers: The number of preprocessing processes.
+    :return: The folder of the cache (to pass to CachedTensorDataset). Images which failed to preprocess
+        are listed in the "errors" of the index and left out of the dataset.
+    """
+    preprocess_kwargs = dict(preprocess_kwargs or {}, target_size=(IMAGE_SIZE, IMAGE_SIZE))
+    # Plain ints (e.g. not numpy integers), so the labels survive the JSON index unchanged
+    labels = [int(label) for label in labels] if labels is not None else None
+    folder = os.path.join(cache_dir, parameters_hash(preprocess_kwargs))
+    index_path = os.path.join(folder, "index.json")
+    sources = _source_signature(paths)
+
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index["sources"] == sources and index["labels"] == labels:
+            return folder
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    elif os.path.exists(index_path):
+        os.remove(index_path)
+    shape = (len(paths), 3, IMAGE_SIZE, IMAGE_SIZE)
+    data_path = os.path.join(folder, "images.npy")
+    with atomic_path(data_path) as tmp_path:
+        images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+        errors = {}
+        for i, image, timings in preprocess_images(paths, max_workers=max_workers, ordered=False, **preprocess_kwargs):
+            if image is None:
+                print(f"Error preprocessing {paths[i]}: {timings['error']}")
+                # JSON object keys are strings
+                errors[str(i)] = timings["error"]
+                continue
+            # padded_resize can be one pixel short when the padding is odd
+            if image.shape[:2] != (IMAGE_SIZE, IMAGE_SIZE):
+                image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE))
+            if image.ndim == 2:
+                image = np.repeat(image[:, :, None], 3, axis=2)
+            images[i] = image.transpose(2, 0, 1)
+        images.flush()
+        del images
+
+    # The index is written last, so an interrupted build is never mistaken for a valid cache
+    with open(index_path, "w") as f:
+        json.dump({"sources": sources, "labels": labels, "shape": shape, "errors": errors,
+                   "parameters": output_parameters(preprocess_kwargs)}, f, default=str)
+    return folder
+
+
+class CachedTensorDataset(Dataset):
+    """
+    Dataset of the preprocessed images of a tensor cache, yielding (image tensor, label) pairs
+    as expected by Classification.training_step.
+    """
+    def __init__(self, folder):
+        with open(os.path.join(folder, "index.json"), "r") as f:
+            index = json.load(f)
+        self.data_path = os.path.join(folder, "images.npy")
+        # Positions in the cache of the images which were preprocessed (the failed ones are left out)
+        errors = index.get("errors", {})
+        self.positions = [i for i in range(len(index["sources"])) if str(i) not in errors]
+        self.paths = [index["sources"][i][0] for i in self.positions]
+        self.labels = [index["labels"][i] for i in self.positions] if index["labels"] is not None else None
+        # Opened lazily, so every DataLoader worker maps the file itself
+        self._images = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        if self._images is None:
+            self._images = np.load(self.data_path, mmap_mode="r")
+        image = torch.from_numpy(np.array(self._images[self.positions[index]]))
+        image = image.float().div_(255).sub_(MEAN).div_(STD)
+        label = self.labels[index] if self.labels is not None else -1
+        return image, label
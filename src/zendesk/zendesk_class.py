@@ -1,9 +1,40 @@
 import zenpy
 import zipfile
 import os
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from ingestion_manifest import (
+    IngestionManifest, file_checksum,
+    TICKET_PENDING, TICKET_COMPLETE, TICKET_FAILED,
+    ATTACHMENT_PENDING, ATTACHMENT_DOWNLOADED, ATTACHMENT_EXTRACTED)
+from image_store import ImageStore
+
+
+def is_rate_limited(exception):
+    """
+    Check if an exception was caused by a Zendesk rate limit response (HTTP 429).
+    """
+    response = getattr(exception, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+def retry_after_seconds(exception, default):
+    """
+    Get the waiting time requested by the Retry-After header of a rate limit response.
+    """
+    headers = getattr(getattr(exception, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
+
+
 class Zendesk:
     """
     A class for interacting with Zendesk. The current implementation focuses on
@@ -11,8 +42,24 @@ class Zendesk:
 
     For initialization, the user needs either an email and a token to the requried views OR
     the user needs to have the ZENDESK_USER and ZENDESK_PWD environment variables set (via an .env file).
+    An already configured client (e.g. a local fake of the zenpy client) can be passed instead,
+    or a function creating one (client_factory).
+
+    The zenpy client (its requests session and response cache) is not thread-safe, so every
+    thread uses its own client, created on first use.
+    A client passed with client= is shared by all the threads.
     """
-    def __init__(self, email=None, token=None):
+    def __init__(self, email=None, token=None, client=None, max_retries=5, backoff_seconds=1.0,
+                 client_factory=None):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._local = threading.local()
+        if client is not None or client_factory is not None:
+            self._client_factory = client_factory or (lambda: client)
+            self.client = client if client is not None else client_factory()
+            self.data_view = os.getenv("ZENDESK_VIEW")
+            return
+
         load_dotenv()
         try:
             self.email = os.getenv("ZENDESK_USER")
@@ -23,71 +70,255 @@ class Zendesk:
         credentials = {'email': self.email,
                         'token': self.token,
                         'subdomain': 'dansktandforsikring'}
+        self._client_factory = lambda: zenpy.Zenpy(**credentials)
         try:
-            self.client = zenpy.Zenpy(**credentials)
+            self.client = self._client_factory()
             self.data_view = os.getenv("ZENDESK_VIEW")
         except:
             raise Exception("Invalid email or token")
 
+    @property
+    def client(self):
+        """
+        The zenpy client of the current thread.
+        """
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._client_factory()
+        return client
+
+    @client.setter
+    def client(self, client):
+        self._local.client = client
+
+    def call_with_backoff(self, func, *args, **kwargs):
+        """
+        Call a Zendesk API function, retrying with exponential backoff when rate limited (HTTP 429).
+        The Retry-After header of the response is respected when present.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                backoff = self.backoff_seconds * 2 ** attempt
+                # Jitter spreads out the retries of the concurrent workers
+                time.sleep(retry_after_seconds(e, backoff) + random.uniform(0, self.backoff_seconds))
+
 
-    def retrieve_dental_images(self, ticket_id, root):
+    def stream_attachment_to_store(self, ticket_id, attachment, image_store, manifest=None):
+        """
+        Downloads a zip attachment into memory and writes only its image members into the
+        content-addressed image store. The zip itself is never written to disk.
+        :return: A list of (member_name, digest, path, is_new) tuples of the stored images
+        """
+        if manifest:
+            manifest.set_attachment_state(attachment.id, ticket_id, attachment.file_name, ATTACHMENT_PENDING)
+        # Without a destination, zenpy returns the content of the attachment as a BytesIO object
+        content = self.call_with_backoff(
+            self.client.attachments.download, attachment_id=attachment.id, destination=None)
+        images = image_store.add_zip_images(content)
+        if manifest:
+            manifest.add_ticket_images(
+                ticket_id, attachment.id, [(member_name, digest, path) for member_name, digest, path, _ in images])
+            manifest.set_attachment_state(
+                attachment.id, ticket_id, attachment.file_name, ATTACHMENT_EXTRACTED,
+                size=content.getbuffer().nbytes, checksum=hashlib.sha256(content.getbuffer()).hexdigest())
+        return images
+
+    def retrieve_dental_images(self, ticket_id, root, manifest=None, image_store=None):
         """
         Scrapes the dental images from the comments of a ticket. Currrently only works
         for local storage.
+        If a manifest is given, attachments which were already extracted are skipped and
+        attachments which were already downloaded (with a matching checksum) are not fetched again.
+        If an image store is given, the images are streamed into the store instead of
+        extracting the zip attachments into root.
+        :return: The number of extracted attachments
         """
-        # TODO: Add error handling
         # TODO: Add GCP bucket upload
 
-        comments = self.client.tickets.comments(ticket_id)
+        # The comments are listed eagerly, so rate limits during the listing are retried as well
+        comments = self.call_with_backoff(lambda: list(self.client.tickets.comments(ticket_id)))
         
-
+        extracted = 0
         # Iterate through comments to find attachments
         for comment in comments:
             for attachment in comment.attachments:
                 # Define the file path
                 file_path = os.path.join(root, attachment.file_name)
+                if not file_path.endswith(".zip"):
+                    continue
 
-                # Download the attachment
-                if file_path.endswith(".zip"):
-                    self.client.attachments.download(attachment_id=attachment.id, destination=file_path)
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(root)
-                    os.remove(file_path)
+                entry = manifest.attachment(attachment.id) if manifest else None
+                if entry is not None and entry["state"] == ATTACHMENT_EXTRACTED:
+                    continue
 
+                if image_store is not None:
+                    self.stream_attachment_to_store(ticket_id, attachment, image_store, manifest=manifest)
+                    extracted += 1
+                    continue
 
-    def get_view_tickets(self, view_id=None):
+                # Download the attachment, unless a complete download is already on disk
+                downloaded = (
+                    entry is not None and entry["state"] == ATTACHMENT_DOWNLOADED
+                    and os.path.exists(file_path) and file_checksum(file_path) == entry["checksum"])
+                if not downloaded:
+                    if manifest:
+                        manifest.set_attachment_state(
+                            attachment.id, ticket_id, attachment.file_name, ATTACHMENT_PENDING)
+                    self.call_with_backoff(
+                        self.client.attachments.download, attachment_id=attachment.id, destination=file_path)
+                    if manifest:
+                        manifest.set_attachment_state(
+                            attachment.id, ticket_id, attachment.file_name, ATTACHMENT_DOWNLOADED,
+                            size=os.path.getsize(file_path), checksum=file_checksum(file_path))
+
+                with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                    zip_ref.extractall(root)
+                os.remove(file_path)
+                if manifest:
+                    manifest.set_attachment_state(
+                        attachment.id, ticket_id, attachment.file_name, ATTACHMENT_EXTRACTED)
+                extracted += 1
+        return extracted
+
+
+    def get_view_tickets(self, view_id=None, start=0, page_size=100):
         """
-        Retrieves all tickets from a view.
+        Retrieves all tickets from a view, optionally starting at a position of the listing.
         """
         if view_id is None:
             view_id = self.data_view
-        return self.client.views.tickets(view_id)
+        return self._iter_view_tickets(view_id, start, page_size)
+
+    def _iter_view_tickets(self, view_id, start, page_size):
+        # The result generator fetches the first page when it is created, so it is created once.
+        # Slicing it only fetches the pages needed for the slice, so the tickets before the
+        # start position are not listed again. Every page is retried when rate limited
+        tickets = self.call_with_backoff(self.client.views.tickets, view_id)
+        position = start
+        while True:
+            page = self.call_with_backoff(lambda: list(tickets[position:position + page_size]))
+            yield from page
+            if len(page) < page_size:
+                return
+            position += len(page)
     
 
-    def retrieve_all_image_data(self, root, break_after=None):
+    def retrieve_ticket(self, ticket_id, root, manifest=None, image_store=None):
+        """
+        Retrieves the image data of a single ticket into <root>/<ticket_id> (or into the image store).
+        With a manifest, only tickets which are not complete yet are retrieved (resuming
+        partially retrieved tickets), otherwise tickets with an existing folder are skipped.
+        :return: A progress report dict with the ticket id, status and number of extracted attachments
+        """
+        temp_root = os.path.join(root, f"{ticket_id}")
+        report = {"ticket_id": ticket_id, "status": "skipped", "attachments": 0, "error": None}
+
+        if manifest is not None:
+            if manifest.ticket_state(ticket_id) == TICKET_COMPLETE:
+                return report
+            manifest.set_ticket_state(ticket_id, TICKET_PENDING)
+        elif os.path.exists(temp_root):
+            print(f"Ticket {ticket_id} already exists in {root}.")
+            return report
+        if image_store is None:
+            os.makedirs(temp_root, exist_ok=True)
+
+        try:
+            report["attachments"] = self.retrieve_dental_images(
+                ticket_id, temp_root, manifest=manifest, image_store=image_store)
+            report["status"] = "downloaded"
+            if manifest is not None:
+                manifest.set_ticket_state(ticket_id, TICKET_COMPLETE)
+        except Exception as e:
+            report["status"] = "failed"
+            report["error"] = str(e)
+            if manifest is not None:
+                manifest.set_ticket_state(ticket_id, TICKET_FAILED, error=str(e))
+        return report
+
+    def retrieve_all_image_data(self, root, break_after=None, max_workers=1, progress_callback=None,
+                                manifest=None, resume=True, image_store=None):
         """
         Retrieves all image data from all tickets in the view.
+        The progress is recorded in an ingestion manifest (<root>/manifest.db by default), so an
+        interrupted ingestion resumes where it stopped: completed tickets and attachments are
+        skipped, and the view is listed from the last position whose tickets were all completed.
+        :param root: The folder to store the images in (one subfolder per ticket)
+        :param break_after: Stop after this many tickets (optional)
+        :param max_workers: The number of tickets downloaded concurrently
+        :param progress_callback: Called with the progress report of every finished ticket (optional)
+        :param manifest: The IngestionManifest to use (optional)
+        :param resume: Start listing the view at the saved cursor. Set to False to list the whole
+            view again (e.g. if tickets were removed from it), completed tickets are still skipped.
+        :param image_store: Stream the images into this ImageStore (or an ImageStore path) instead of
+            extracting the attachments into one folder per ticket. The tickets' images are listed by
+            manifest.ticket_images().
+        :return: The progress reports of all the tickets
         """
         # TODO: Expand to GCP bucket upload
 
-        tickets = self.get_view_tickets()
+        if not os.path.exists(root):
+            os.makedirs(root)
+        if manifest is None:
+            manifest = IngestionManifest(os.path.join(root, "manifest.db"))
+        if isinstance(image_store, str):
+            image_store = ImageStore(image_store)
 
-        for index, ticket in tqdm(enumerate(tickets)):
+        start = manifest.cursor(self.data_view) if resume else 0
+        tickets = self.get_view_tickets(start=start)
+        reports = []
+        # Positions (in the view listing) of the finished tickets, used to advance the cursor
+        finished = {}
+        cursor = {"position": start, "blocked": False}
 
-            # Break after a certain number of tickets
-            if break_after is not None:
-                if index > break_after:
-                    print(f"Breaking after {break_after} tickets.")
+        def finish(future):
+            report = future.result()
+            reports.append(report)
+            progress.update(1)
+            progress.set_postfix(ticket=report["ticket_id"], status=report["status"])
+            if report["status"] == "failed":
+                print(f"Ticket {report['ticket_id']} failed: {report['error']}")
+            if progress_callback is not None:
+                progress_callback(report)
+
+            # The cursor only moves past tickets that are done, so failed tickets are listed again
+            finished[positions.pop(future)] = report
+            while not cursor["blocked"] and cursor["position"] in finished:
+                report = finished.pop(cursor["position"])
+                if report["status"] == "failed":
+                    cursor["blocked"] = True
                     break
+                cursor["position"] += 1
+                manifest.set_cursor(self.data_view, cursor["position"], report["ticket_id"])
+
+        positions = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(unit="ticket", initial=start) as progress:
+            in_flight = set()
+            for index, ticket in enumerate(tickets):
+
+                # Break after a certain number of tickets
+                if break_after is not None:
+                    if index > break_after:
+                        print(f"Breaking after {break_after} tickets.")
+                        break
+
+                # Keep the number of queued tickets bounded, so the view is listed lazily
+                if len(in_flight) >= 2 * max_workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+                future = executor.submit(self.retrieve_ticket, ticket.id, root, manifest, image_store)
+                positions[future] = start + index
+                in_flight.add(future)
 
-            temp_root = os.path.join(root, f"{ticket.id}")
+            for future in wait(in_flight).done:
+                finish(future)
 
-            if not os.path.exists(temp_root):
-                os.makedirs(temp_root)
-            else:
-                print(f"Ticket {ticket.id} already exists in {root}.")
-                continue
-            self.retrieve_dental_images(ticket.id, temp_root)
+        return reports
             
             
 